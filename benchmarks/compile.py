@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""
+Compile time of queries with large `in` lists, many parenthesized terms and
+deep `and`/`or` trees,
+time per param should stay flat as the number of params grows::
+
+    $ python benchmarks/compile.py
+"""
+
+import sys
+import sqlite3
+from timeit import default_timer
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+
+from skylark import Model, Field, compiler, database
+
+
+class User(Model):
+    name = Field()
+    email = Field()
+
+
+def in_list(n):
+    return User.where(User.id._in(*range(n))).select(User.id)
+
+
+def or_terms(n):  # n // 2 parenthesized terms joined with 'and'
+    terms = [(User.id == i) | (User.name == i) for i in range(n // 2)]
+    return User.where(*terms).select(User.id)
+
+
+def and_or_tree(n):
+    def tree(lo, hi, depth):
+        if hi - lo == 1:
+            return User.id == lo
+        mid = (lo + hi) // 2
+        left, right = tree(lo, mid, depth + 1), tree(mid, hi, depth + 1)
+        return (left | right) if depth % 2 else (left & right)
+    return User.where(tree(0, n, 0)).select(User.id)
+
+
+def bench(func, n, times=3):
+    best = None
+    for i in range(times):
+        start = default_timer()
+        query = func(n)
+        cost = default_timer() - start
+        best = cost if best is None else min(best, cost)
+    assert len(query.sql.params) == n
+    return best
+
+
+def main():
+    database.set_dbapi(sqlite3)
+    compiler.cache_size = 0  # measure compiling, not the cache
+
+    for func in (in_list, or_terms, and_or_tree):
+        print(func.__name__)
+        for n in (1000, 10000, 100000):
+            cost = bench(func, n)
+            print('  %6d params: %8.2f ms, %6.2f us/param' % (
+                n, cost * 1000, cost * 1e6 / n))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""
+Time to `import skylark` in a fresh interpreter, db connectors are imported
+on first use, so it should stay close to the cost of the stdlib modules it
+needs::
+
+    $ python benchmarks/importtime.py
+"""
+
+import os
+import sys
+import subprocess
+from timeit import default_timer
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+path = os.path.dirname(here)
+
+
+def run(code):
+    env = dict(os.environ, PYTHONPATH=path)
+    start = default_timer()
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+    return default_timer() - start
+
+
+def bench(code, times=10):
+    return min(run(code) for i in range(times))
+
+
+def main():
+    base = bench('pass')
+    cases = [
+        ('import skylark', 'import skylark'),
+        ('import skylark, sqlite3', 'import skylark, sqlite3'),
+        ('first connection', 'import skylark, sqlite3; '
+         'skylark.database.set_dbapi(sqlite3); '
+         'skylark.database.config(db=":memory:"); '
+         'skylark.database.get_conn()'),
+    ]
+
+    print('interpreter startup: %8.2f ms' % (base * 1000))
+    for name, code in cases:
+        cost = bench(code) - base
+        print('%-24s +%8.2f ms' % (name, cost * 1000))
+
+    # skylark must not import any connector by itself
+    code = ('import sys, skylark; '
+            'assert not set(skylark.DBAPI_LOAD_ORDER) & set(sys.modules)')
+    run(code)
+
+
+if __name__ == '__main__':
+    main()
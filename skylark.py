@@ -22,6 +22,15 @@ __all__ = (
     'PrimaryKeyValueNotFound',
     'SQLSyntaxError',
     'ForeignKeyNotFound',
+    'PoolTimeout',
+    'TransactionAborted',
+    'ShardKeyNotFound',
+    'PartitionKeyNotFound',
+    'PartitionNotFound',
+    'ConnectionPool',
+    'Sharding',
+    'HashPartitioning',
+    'MonthPartitioning',
     'Database', 'database',
     'sql', 'SQL',
     'Field',
@@ -29,14 +38,26 @@ __all__ = (
     'ForeignKey',
     'compiler',
     'fn',
-    'distinct', 'Distinct'
+    'distinct', 'Distinct',
     'Model',
     'MultiModels', 'Models',
-    'JoinModel'
+    'JoinModel',
+    'Builder',
 )
 
 
+import os
+import re
 import sys
+import zlib
+import time
+import bisect
+import threading
+from array import array
+from collections import namedtuple
+from functools import wraps
+from itertools import islice
+from operator import attrgetter, itemgetter
 
 
 if sys.hexversion < 0x03000000:
@@ -46,6 +67,17 @@ else:
 
 if PY_VERSION == 3:
     from functools import reduce
+    integer_types = (int, )
+else:
+    integer_types = (int, long)
+
+try:
+    from contextvars import ContextVar, copy_context  # py3.7+
+except ImportError:
+    ContextVar = copy_context = None
+
+# monotonic clock for timeouts (py3.3+), fallback to wall clock
+_now = getattr(time, 'monotonic', time.time)
 
 
 # common operators (~100)
@@ -89,6 +121,7 @@ RT_LM = 8
 RT_JN = 9
 RT_TG = 10
 RT_FM = 11
+RT_RW = 12
 
 
 # query types
@@ -118,6 +151,51 @@ class ForeignKeyNotFound(SkylarkException):
     pass
 
 
+class PoolTimeout(SkylarkException):
+    pass
+
+
+class TransactionAborted(SkylarkException):
+    pass
+
+
+class ShardKeyNotFound(SkylarkException):
+    pass
+
+
+class PartitionKeyNotFound(SkylarkException):
+    pass
+
+
+class PartitionNotFound(SkylarkException):
+    pass
+
+
+class ContextLocal(object):
+    # a value local to current thread, and to current asyncio task on py3.7+
+    # (contextvars). values should be replaced, never mutated in place, since
+    # child tasks start with their parent's values.
+
+    def __init__(self, name, default=None):
+        self.default = default
+        if ContextVar is not None:
+            self.var = ContextVar(name)
+        else:
+            self.var = None
+            self.local = threading.local()
+
+    def get(self):
+        if self.var is not None:
+            return self.var.get(self.default)
+        return getattr(self.local, 'value', self.default)
+
+    def set(self, value):
+        if self.var is not None:
+            self.var.set(value)
+        else:
+            self.local.value = value
+
+
 class DBAPI(object):
 
     placeholder = '%s'
@@ -147,16 +225,52 @@ class DBAPI(object):
     def get_cursor(self, conn):
         return conn.cursor()
 
+    def get_stream_cursor(self, conn):  # unbuffered, server side cursor
+        return conn.cursor(self.module.cursors.SSCursor)
+
     def execute_cursor(self, cursor, args):
         return cursor.execute(*args)
 
+    def buffer_cursor(self, cursor):
+        # a cursor whose rows can be read once its connection is reused,
+        # mysql clients read the whole result on execute
+        return cursor
+
+    # limits of a statement, None for no limit: max number of params, max
+    # bytes (mysql's max_allowed_packet, 4MB by default since 5.6)
+    max_params = None
+    max_packet = 1 << 22
+
+    def sizeof(self, val):  # estimated size of an escaped value in a query
+        return 2 * len('%s' % (val, )) + 4
+
+    def inserted_ids(self, cursor, count):
+        # ids of a multi-rows insert are consecutive, lastrowid is the first
+        return list(range(cursor.lastrowid, cursor.lastrowid + count))
+
+    # mysql client errors: server has gone away, lost connection during query
+    # and lost connection at handshake
+    disconnect_errors = (2006, 2013, 2055)
+
+    def is_disconnect(self, exc):
+        return isinstance(exc, self.module.OperationalError) and \
+            bool(exc.args) and exc.args[0] in self.disconnect_errors
+
+    # mysql client errors: can't connect via socket, via tcp, unknown host
+    unavailable_errors = (2002, 2003, 2005)
+
+    def is_unavailable(self, exc):  # the server is down or unreachable
+        return self.is_disconnect(exc) or \
+            isinstance(exc, self.module.OperationalError) and \
+            bool(exc.args) and exc.args[0] in self.unavailable_errors
+
     def select_db(self, db, conn, configs):
         configs.update({'db': db})
         if self.conn_is_open(conn):
             conn.select_db(db)
 
     def begin_transaction(self, conn):
-        pass
+        return self.get_cursor(conn).execute('begin')
 
     def commit_transaction(self, conn):
         return conn.commit()
@@ -164,6 +278,29 @@ class DBAPI(object):
     def rollback_transaction(self, conn):
         return conn.rollback()
 
+    def savepoint(self, conn, name):
+        return self.get_cursor(conn).execute('savepoint %s' % name)
+
+    def release_savepoint(self, conn, name):
+        return self.get_cursor(conn).execute('release savepoint %s' % name)
+
+    def rollback_savepoint(self, conn, name):
+        cursor = self.get_cursor(conn)
+        cursor.execute('rollback to savepoint %s' % name)
+        return cursor.execute('release savepoint %s' % name)
+
+    def execute_async(self, database, query):
+        # awaitable of query.execute(). natively async adapters (registered
+        # in DBAPI_MAPPINGS) override this and `stream_async`, to run
+        # query.sql on their driver and build the result with query.result.
+        return database.run_async(query.execute)
+
+    def stream_async(self, database, sql, size):
+        # function returning an awaitable of the next chunk of rows of a
+        # select, an empty chunk at the end.
+        chunks = database.stream_chunks(sql, size=size)
+        return lambda: database.run_async(next, chunks, ())
+
 
 class MySQLdbAPI(DBAPI):
     pass
@@ -174,11 +311,38 @@ class PyMySQLAPI(DBAPI):
     def conn_is_open(self, conn):
         return conn and conn.socket and conn._rfile
 
+    def is_disconnect(self, exc):
+        # pymysql raises InterfaceError on a connection closed under it
+        return isinstance(exc, self.module.InterfaceError) or \
+            super(PyMySQLAPI, self).is_disconnect(exc)
+
 
 class Sqlite3API(DBAPI):
 
     placeholder = '?'
 
+    max_packet = None
+
+    def __init__(self, module):
+        super(Sqlite3API, self).__init__(module)
+        # SQLITE_MAX_VARIABLE_NUMBER defaults to 999 before 3.32.0
+        if module.sqlite_version_info < (3, 32, 0):
+            self.max_params = 999
+        else:
+            self.max_params = 32766
+
+    def get_stream_cursor(self, conn):
+        return conn.cursor()  # sqlite3 cursors step rows lazily
+
+    def buffer_cursor(self, cursor):
+        if cursor.description is None:  # no rows
+            return cursor
+        return BufferedCursor(cursor)
+
+    def inserted_ids(self, cursor, count):
+        # lastrowid is the last one
+        return list(range(cursor.lastrowid - count + 1, cursor.lastrowid + 1))
+
     def conn_is_open(self, conn):
         if conn:
             try:
@@ -189,9 +353,49 @@ class Sqlite3API(DBAPI):
             return True
         return False
 
+    # options of sqlite3.connect taken from configs
+    connect_options = ('timeout', 'detect_types', 'cached_statements', 'uri')
+
+    # presets of pragmas, by configs['profile'], e.g.
+    # Database.config(db='mydb', profile='read', pragmas={'cache_size': -8000})
+    profiles = {
+        'read': {  # concurrent readers, a writer doesn't block them
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'cache_size': -64000,  # KiB
+            'mmap_size': 1 << 28,
+            'temp_store': 'memory',
+            'busy_timeout': 5000,  # ms
+        },
+        'bulk': {  # loading lots of rows, may lose the last commits on crash
+            'journal_mode': 'wal',
+            'synchronous': 'off',
+            'cache_size': -256000,
+            'temp_store': 'memory',
+            'busy_timeout': 5000,
+        },
+    }
+
+    def get_pragmas(self, configs):
+        pragmas = {}
+        if configs.get('profile') is not None:
+            pragmas.update(self.profiles[configs['profile']])
+        pragmas.update(configs.get('pragmas') or {})
+        return pragmas
+
     def connect(self, configs):
-        db = configs['db']
-        return self.module.connect(db)
+        options = dict((key, configs[key]) for key in self.connect_options
+                       if key in configs)
+        # pooled connections may be handed between threads
+        conn = self.module.connect(
+            configs['db'], check_same_thread=False, **options)
+
+        # on every new connection, journal_mode first
+        pragmas = sorted(self.get_pragmas(configs).items(),
+                         key=lambda item: (item[0] != 'journal_mode', item[0]))
+        for name, value in pragmas:
+            conn.execute('pragma %s = %s' % (name, value))
+        return conn
 
     def set_autocommit(self, conn, boolean):
         if boolean:
@@ -208,6 +412,9 @@ class Sqlite3API(DBAPI):
     def conn_is_alive(self, conn):
         return 1   # sqlite is serverless
 
+    def is_disconnect(self, exc):
+        return False
+
 
 DBAPI_MAPPINGS = {
     'MySQLdb': MySQLdbAPI,
@@ -219,106 +426,1061 @@ DBAPI_MAPPINGS = {
 DBAPI_LOAD_ORDER = ('MySQLdb', 'pymysql', 'sqlite3')
 
 
+class ConnectionPool(object):
+
+    def __init__(self, dbapi, configs, autocommit=True, size=10, min_size=0,
+                 timeout=30, idle_timeout=None, max_lifetime=None,
+                 ping_interval=30):
+        self.dbapi = dbapi
+        self.configs = configs
+        self.autocommit = autocommit
+        self.size = size  # max connections, idle and in use
+        self.min_size = min_size  # idle connections never evicted below it
+        self.timeout = timeout  # seconds to wait in acquire, None: forever
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        # connections idle longer than this are pinged before reuse,
+        # None: never ping
+        self.ping_interval = ping_interval
+        self.idle = []  # lifo stack, keeps hot connections hot
+        self.states = {}  # id(conn) => {'created': .., 'used': ..}
+        self.pending = 0  # connections being opened
+        self.closed = False
+        self.cond = threading.Condition()
+
+    @property
+    def count(self):  # connections opened (or opening) by this pool
+        return len(self.states) + self.pending
+
+    def expired(self, conn, now):
+        if self.max_lifetime is None:
+            return False
+        return now - self.states[id(conn)]['created'] > self.max_lifetime
+
+    def check_alive(self, conn, used, now):
+        # ping only connections sat idle past ping_interval
+        if self.ping_interval is None or now - used <= self.ping_interval:
+            return True
+        return self.dbapi.conn_is_alive(conn)
+
+    def open(self):
+        # open a new connection, the caller has reserved a slot in pending
+        try:
+            conn = self.dbapi.connect(self.configs)
+            self.dbapi.set_autocommit(conn, self.autocommit)
+        except Exception:
+            with self.cond:
+                self.pending -= 1
+                self.cond.notify()
+            raise
+
+        with self.cond:
+            self.pending -= 1
+            now = _now()
+            self.states[id(conn)] = {
+                'created': now, 'used': now, 'autocommit': self.autocommit}
+        return conn
+
+    def fill(self):  # pre-open idle connections up to min_size
+        while True:
+            with self.cond:
+                if self.closed or self.count >= self.min_size:
+                    return
+                self.pending += 1
+            self.release(self.open())
+
+    def acquire(self, wait=True):
+        # wait: wait for a connection at most `timeout` seconds, else raise
+        # PoolTimeout at once if there is no connection to give.
+        if self.count < self.min_size:
+            self.fill()
+
+        timeout = self.timeout if wait else 0
+        deadline = None if timeout is None else _now() + timeout
+
+        while True:
+            conn, used, reserved = self.take(deadline)
+            if conn is None:
+                if not reserved:
+                    raise PoolTimeout
+                return self.open()
+            # pinged out of the lock, others don't wait for the round trip
+            if self.check_alive(conn, used, _now()):
+                self.set_autocommit(conn)
+                return conn
+            self.detach(conn)  # dead, dropped
+            self.close_conn(conn)
+
+    def take(self, deadline):
+        # (conn, last used, reserved): an idle connection, else a slot
+        # reserved in pending to open one, else (None, None, False) after
+        # the deadline.
+        discards = []
+        result = (None, None, False)
+
+        with self.cond:
+            while True:
+                now = _now()
+
+                while self.idle:
+                    conn = self.idle.pop()
+                    state = self.states[id(conn)]
+                    if self.dbapi.conn_is_open(conn) and \
+                            not self.expired(conn, now):
+                        result = (conn, state['used'], False)
+                        state['used'] = now
+                        break
+                    del self.states[id(conn)]
+                    discards.append(conn)
+
+                if result[0] is not None:
+                    break
+
+                if self.count < self.size:
+                    self.pending += 1
+                    result = (None, None, True)
+                    break
+
+                if deadline is None:
+                    self.cond.wait()
+                elif deadline > now:
+                    self.cond.wait(deadline - now)
+                else:
+                    break
+
+        for discard in discards:
+            self.close_conn(discard)
+        return result
+
+    def set_autocommit(self, conn):
+        # the pool's mode may have changed while the connection was idle
+        state = self.states[id(conn)]
+        if state.get('autocommit') != self.autocommit:
+            self.dbapi.set_autocommit(conn, self.autocommit)
+            state['autocommit'] = self.autocommit
+
+    def release(self, conn):
+        discards = []
+
+        with self.cond:
+            if id(conn) not in self.states:
+                return  # not from this pool, or already discarded
+
+            now = _now()
+
+            if self.closed or not self.dbapi.conn_is_open(conn) or \
+                    self.expired(conn, now):
+                del self.states[id(conn)]
+                discards.append(conn)
+            else:
+                self.states[id(conn)]['used'] = now
+                self.idle.append(conn)
+
+            discards.extend(self.evict(now))
+            self.cond.notify()
+
+        for discard in discards:
+            self.close_conn(discard)
+
+    def evict(self, now):
+        # remove connections idle too long, the least recently used is at
+        # the bottom of the stack
+        evicted = []
+
+        if self.idle_timeout is None:
+            return evicted
+
+        while self.idle and self.count > self.min_size:
+            conn = self.idle[0]
+            if now - self.states[id(conn)]['used'] <= self.idle_timeout:
+                break
+            self.idle.pop(0)
+            del self.states[id(conn)]
+            evicted.append(conn)
+        return evicted
+
+    def detach(self, conn):
+        # stop tracking an in-use connection, returns its state
+        with self.cond:
+            state = self.states.pop(id(conn), None)
+            self.cond.notify()
+        return state
+
+    def attach(self, conn, state):
+        # track an in-use connection detached from another pool
+        with self.cond:
+            self.states[id(conn)] = state
+
+    def close_conn(self, conn):
+        try:
+            if self.dbapi.conn_is_open(conn):
+                self.dbapi.close_conn(conn)
+        except Exception:
+            pass  # already broken
+
+    def close(self):
+        # close idle connections, in-use ones are closed on release
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            for conn in idle:
+                del self.states[id(conn)]
+            self.cond.notify_all()
+
+        for conn in idle:
+            self.close_conn(conn)
+
+
+class BufferedCursor(object):
+    # rows of a cursor read ahead, so its connection can go back to the pool
+    # before they are fetched
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rows = cursor.fetchall()
+        self.pos = 0
+
+    def __getattr__(self, name):  # description, rowcount, lastrowid, close..
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.cursor.arraysize
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return rows
+
+
+class ConnectionHolder(object):
+    # thread local binding of a pooled connection, gives it back to its pool
+    # once unbound or its thread exits
+
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+        self.used = _now()  # last time the connection was used
+
+    def release(self):
+        conn, self.conn = self.conn, None
+        if conn is not None and self.pool is not None:
+            self.pool.release(conn)
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+class WriteJob(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.cursor = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Writer(object):
+    # a thread with the only connection writing to the database (sqlite
+    # takes one writer at a time), applies writes queued by other threads.
+    # writes queued meanwhile, `batch` at most, are applied in one
+    # transaction, each within a savepoint so a failed one doesn't undo the
+    # others, and each thread waits until its write is committed.
+
+    savepoint = 'skylark_write'
+
+    def __init__(self, dbapi, configs, batch=100):
+        try:
+            from queue import Queue
+        except ImportError:  # py2
+            from Queue import Queue
+        self.dbapi = dbapi
+        self.configs = configs
+        self.batch = batch
+        self.queue = Queue()
+        self.conn = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def execute(self, args):  # cursor of a write, once committed
+        job = WriteJob(args)
+        self.queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.cursor
+
+    def close(self):  # after queued writes are applied
+        self.queue.put(None)
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        from_queue = self.queue.get
+        closing = False
+
+        while not closing:
+            jobs = []
+            job = from_queue()
+            while job is not None:
+                jobs.append(job)
+                if len(jobs) >= self.batch or self.queue.empty():
+                    break
+                job = from_queue()
+            closing = job is None
+            if jobs:
+                self.apply(jobs)
+
+        if self.conn is not None and self.dbapi.conn_is_open(self.conn):
+            self.dbapi.close_conn(self.conn)
+
+    def get_conn(self):
+        if self.conn is None or not self.dbapi.conn_is_open(self.conn):
+            self.conn = self.dbapi.connect(self.configs)
+            self.dbapi.set_autocommit(self.conn, True)  # begins by itself
+        return self.conn
+
+    def apply(self, jobs):
+        conn = None
+        try:
+            conn = self.get_conn()
+            self.dbapi.begin_transaction(conn)
+            for job in jobs:
+                self.apply_job(conn, job, len(jobs) > 1)
+            self.dbapi.commit_transaction(conn)
+        except Exception as exc:  # nothing committed
+            for job in jobs:
+                job.error = job.error or exc
+            try:
+                if conn is not None:
+                    self.dbapi.rollback_transaction(conn)
+            except Exception:
+                self.conn = None  # broken, reconnect
+        finally:
+            for job in jobs:
+                job.done.set()
+
+    def apply_job(self, conn, job, savepoint):
+        if savepoint:
+            self.dbapi.savepoint(conn, self.savepoint)
+        try:
+            job.cursor = self.dbapi.get_cursor(conn)
+            self.dbapi.execute_cursor(job.cursor, job.args)
+        except Exception as exc:
+            job.error = exc
+            if savepoint:
+                self.dbapi.rollback_savepoint(conn, self.savepoint)
+            return
+        if savepoint:
+            self.dbapi.release_savepoint(conn, self.savepoint)
+
+
+_inherited = []  # state of a parent process, kept but never used or closed
+
+_worker = threading.local()  # worker threads are running a job
+
+
 class DatabaseType(object):
 
+    pool_defaults = {
+        'size': 10,
+        'min_size': 0,
+        'timeout': 30,
+        'idle_timeout': None,
+        'max_lifetime': None,
+        'ping_interval': 30,
+    }
+
     def __init__(self):
-        self.dbapi = None
-        self.conn = None
+        self._dbapi = None  # resolved on first use, see `dbapi`
+        self.pid = os.getpid()  # process owning the connections
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pool_configs = dict(self.pool_defaults)
         self.configs = {}
         self.autocommit = None
+        self.async_workers = None  # defaults to pool size
+        self.executor = None
+        self.replicas = {}  # name => DatabaseType of a read replica
+        self.sticky_window = 1  # seconds reads stay on primary after writes
+        self.sticky = ContextLocal('skylark.sticky', 0)  # until when
+        self.probe_interval = 5  # seconds between health checks of replicas
+        self.prober = None
+        self.tenants = {}  # db name => DatabaseType of a tenant's schema
+        self.tenant_name = ContextLocal('skylark.tenant')
+        self.use_writer = False  # writes out of transactions to the writer
+        self.writer_batch = 100  # max writes in a transaction of the writer
+        self.writer = None
+
+    def _get_dbapi(self):
+        # the first connector found in DBAPI_LOAD_ORDER, imported on first
+        # use instead of at import time, unless one was set by `set_dbapi`
+        if self._dbapi is None:
+            for name in DBAPI_LOAD_ORDER:
+                try:
+                    module = __import__(name)
+                except ImportError:
+                    continue
+                self._dbapi = DBAPI_MAPPINGS[name](module)
+                break
+        return self._dbapi
+
+    def _set_dbapi(self, dbapi):
+        self._dbapi = dbapi
+
+    dbapi = property(_get_dbapi, _set_dbapi)
+
+    def check_fork(self):
+        # in a child process after a fork, forget the connections, pools and
+        # threads of the parent: they are kept referenced, never closed, since
+        # closing a connection (even on garbage collection) would hang up the
+        # parent's session on the shared socket.
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        self.pid = pid
+        _inherited.append((self.local, self.pool, self.executor, self.writer))
+        self.local = threading.local()
+        self.lock = threading.Lock()  # may be held by a thread of the parent
+        self.pool = None
+        self.executor = None
+        self.prober = None
+        self.writer = None
+
+        for db in list(self.replicas.values()) + list(self.tenants.values()):
+            db.check_fork()
+        if self.replicas and self.probe_interval:
+            self.start_probe()
+
+    def get_holder(self):
+        return getattr(self.local, 'holder', None)
+
+    def _get_conn(self):  # connection bound to current thread
+        holder = self.get_holder()
+        if holder is not None:
+            return holder.conn
+        return None
 
-        for name in DBAPI_LOAD_ORDER:
-            try:
-                module = __import__(name)
-            except ImportError:
-                continue
-            self.set_dbapi(module)
-            break
+    def _set_conn(self, conn):
+        self.bind(conn, self.pool)
+
+    conn = property(_get_conn, _set_conn)
+
+    def bind(self, conn, pool):
+        # bind conn to current thread, the old one goes back to its pool
+        holder = self.get_holder()
+        if holder is not None and holder.conn is conn:
+            holder.pool = pool
+            return
+        self.local.holder = ConnectionHolder(pool, conn)
+        if holder is not None:
+            holder.release()
 
     def set_dbapi(self, module):
         name = module.__name__
 
         if name in DBAPI_MAPPINGS:
-            # clear current configs and connection
-            if self.dbapi and self.dbapi.conn_is_open(self.conn):
-                self.conn.close()
+            # clear current configs, replicas and connections
+            self.close()
             self.configs = {}
-            self.conn = None
+            self.replicas = {}
+            self.tenants = {}
             self.dbapi = DBAPI_MAPPINGS[name](module)
         else:
             raise UnSupportedDBAPI
 
     def config(self, **configs):
         self.autocommit = configs.pop('autocommit', True)
+        self.async_workers = configs.pop('async_workers', None)
+        self.sticky_window = configs.pop('sticky_window', 1)
+        self.probe_interval = configs.pop('probe_interval', 5)
+        self.use_writer = configs.pop('writer', False)
+        self.writer_batch = configs.pop('writer_batch', 100)
+
+        for key in self.pool_defaults:
+            if 'pool_' + key in configs:
+                self.pool_configs[key] = configs.pop('pool_' + key)
+
         self.configs.update(configs)
 
-        # close active connection on configs change
-        if self.dbapi.conn_is_open(self.conn):
-            self.dbapi.close_conn(self.conn)
+        # close active connections on configs change
+        self.close()
+        self.tenants = {}
+
+    def add_replica(self, name, **configs):
+        # add a read replica, configs are merged into the primary's, e.g.
+        # Database.add_replica('r1', host='10.0.0.2')
+        replica = Replica(name)
+        replica.dbapi = self.dbapi
+        replica.configs = dict(self.configs, **configs)
+        replica.pool_configs = dict(self.pool_configs)
+        replica.autocommit = True
+        self.remove_replica(name)
+        self.replicas[name] = replica
+
+        if self.probe_interval:
+            self.start_probe()
+        return replica
+
+    def remove_replica(self, name):
+        replica = self.replicas.pop(name, None)
+        if replica is not None:
+            replica.close()
+
+    def tenant(self, name):
+        # context routing queries of current thread (or asyncio task) to
+        # schema `name`, on a pool of its own: `with Database.tenant('acme'):`
+        return Tenant(self, name)
+
+    def get_tenant(self, name):
+        db = self.tenants.get(name)
+        if db is None:
+            with self.lock:
+                db = self.tenants.get(name)
+                if db is None:
+                    db = DatabaseType()
+                    db.dbapi = self.dbapi
+                    db.configs = dict(self.configs, db=name)
+                    db.pool_configs = dict(self.pool_configs)
+                    db.autocommit = self.autocommit
+                    db.use_writer = self.use_writer
+                    db.writer_batch = self.writer_batch
+                    self.tenants[name] = db
+        return db
+
+    def current(self):  # database of current tenant, or this one
+        name = self.tenant_name.get()
+        if name is None:
+            return self
+        return self.get_tenant(name)
+
+    def in_transaction(self):
+        return not self.autocommit or getattr(self.local, 'transaction', False)
+
+    def stick(self):  # keep reads of current scope on primary for a while
+        if self.replicas:
+            self.sticky.set(_now() + self.sticky_window)
+
+    def route(self, read, exclude=None):
+        # database to run a query on: a replica (but `exclude`) for reads out
+        # of transactions and out of the sticky window after a write, else
+        # this one (the primary).
+        name = self.tenant_name.get()
+        if name is not None:
+            return self.get_tenant(name).route(read, exclude)
+
+        if not read:
+            self.stick()
+        elif self.replicas and not self.in_transaction() and \
+                self.sticky.get() <= _now():
+            replica = self.choose_replica(exclude)
+            if replica is not None:
+                return replica
+        return self
+
+    def choose_replica(self, exclude=None):
+        # the healthy replica with the lowest latency, None if all ejected
+        replicas = [r for r in self.replicas.values()
+                    if r.healthy and r is not exclude]
+        if replicas:
+            return min(replicas, key=attrgetter('latency'))
+        return None
+
+    def start_probe(self):
+        with self.lock:
+            if self.prober is None:
+                self.prober = threading.Thread(target=self.probe_replicas)
+                self.prober.daemon = True
+                self.prober.start()
+
+    def probe_replicas(self):
+        # health checks of replicas in background, ejected ones come back
+        # once they answer again.
+        while True:
+            time.sleep(self.probe_interval or 0)
+
+            with self.lock:
+                if not self.replicas or not self.probe_interval:
+                    self.prober = None
+                    return
+                replicas = list(self.replicas.values())
+
+            for replica in replicas:
+                replica.probe()
+
+    def get_pool(self):
+        self.check_fork()
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ConnectionPool(
+                        self.dbapi, self.configs, autocommit=self.autocommit,
+                        **self.pool_configs)
+        return self.pool
+
+    def get_writer(self):
+        self.check_fork()
+        if self.writer is None:
+            with self.lock:
+                if self.writer is None:
+                    self.writer = Writer(
+                        self.dbapi, self.configs, batch=self.writer_batch)
+        return self.writer
 
     def connect(self):
-        self.conn = self.dbapi.connect(self.configs)
-        self.dbapi.set_autocommit(self.conn, self.autocommit)
-        return self.conn
+        # open a new connection, and bind it to current thread
+        pool = self.get_pool()
+        with pool.cond:
+            pool.pending += 1  # may overflow pool size
+        conn = pool.open()
+        self.bind(conn, pool)
+        return conn
 
     def get_conn(self):
-        if not (
-            self.dbapi.conn_is_open(self.conn) and
-            self.dbapi.conn_is_alive(self.conn)
-        ):
-            self.connect()
-        return self.conn
+        self.check_fork()
+        if getattr(self.local, 'aborted', False):
+            raise TransactionAborted  # its connection was lost
+        holder = self.get_holder()
+
+        if holder is not None and holder.conn is not None:
+            conn = holder.conn
+            now = _now()
+            if holder.pool is not None and holder.pool is self.pool and \
+                    self.dbapi.conn_is_open(conn):
+                if holder.pool.check_alive(conn, holder.used, now):
+                    holder.used = now
+                    return conn
+                self.discard()  # dead, not given back to the pool
+                if getattr(self.local, 'aborted', False):
+                    raise TransactionAborted
+
+        pool = self.get_pool()
+        conn = pool.acquire()
+        self.bind(conn, pool)
+        return conn
+
+    def unbind(self):  # give current thread's connection back to its pool
+        holder = self.get_holder()
+        if holder is not None:
+            holder.release()
+            self.local.holder = None
+
+    def discard(self):
+        # close current thread's connection (maybe broken) and unbind it, a
+        # transaction on it fails till its end
+        self.check_fork()
+        if getattr(self.local, 'transaction', 0):
+            self.local.aborted = True
+        holder = self.get_holder()
+        if holder is not None:
+            if holder.conn is not None:
+                if holder.pool is not None:
+                    holder.pool.close_conn(holder.conn)
+                elif self.dbapi.conn_is_open(holder.conn):
+                    self.dbapi.close_conn(holder.conn)
+            holder.release()
+            self.local.holder = None
+
+    def release(self):
+        # give current thread's connections (and tenants') back to the pools
+        for db in list(self.tenants.values()):
+            db.release()
+
+        self.check_fork()
+        holder = self.get_holder()
+        if holder is not None:
+            if holder.conn is not None and self.in_transaction() and \
+                    self.dbapi.conn_is_open(holder.conn):
+                self.dbapi.rollback_transaction(holder.conn)  # discard
+            self.unbind()
+            self.local.transaction = 0
+        self.local.aborted = False
+
+        for db in list(self.replicas.values()) + list(self.tenants.values()):
+            db.release()
+
+    def close(self):
+        # close current thread's connection and all pooled connections
+        self.check_fork()
+        if self._dbapi is not None:
+            self.discard()
+
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+
+        for db in list(self.replicas.values()) + list(self.tenants.values()):
+            db.close()
 
     def __del__(self):
-        if self.dbapi.conn_is_open(self.conn):
-            return self.dbapi.close_conn(self.conn)
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def get_executor(self):
+        # bounded pool of worker threads for the async api, each query runs
+        # on a worker with a pooled connection, released after.
+        self.check_fork()
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    from concurrent.futures import ThreadPoolExecutor  # py3.2+
+                    workers = self.async_workers or self.pool_configs['size']
+                    self.executor = ThreadPoolExecutor(max_workers=workers)
+        return self.executor
+
+    def run_job(self, func, *args):  # on a worker
+        nested, _worker.active = getattr(_worker, 'active', False), True
+        try:
+            return func(*args)
+        finally:
+            _worker.active = nested
+            if self.autocommit:
+                self.release()
+
+    def submit(self, func, *args):
+        # run func(*args) on a worker, in a copy of current context (py3.7+)
+        # so it sees the replica stickiness of the caller.
+        executor = self.get_executor()
+        if copy_context is not None:
+            return executor.submit(
+                copy_context().run, self.run_job, func, *args)
+        return executor.submit(self.run_job, func, *args)
+
+    def run_async(self, func, *args):
+        # run blocking func(*args) on a worker, returns an awaitable
+        import asyncio  # py3.4+
+        return asyncio.wrap_future(self.submit(func, *args))
+
+    def gather(self, *queries):
+        # execute queries (or call functions) at the same time on workers,
+        # each with a pooled connection, returns their results in order.
+        # in a transaction, they are executed one by one on its connection,
+        # and on a worker too (waiting for other workers could deadlock).
+        funcs = [getattr(query, 'execute', query) for query in queries]
+
+        if self.current().in_transaction() or len(funcs) < 2 or \
+                getattr(_worker, 'active', False):
+            return [func() for func in funcs]
+
+        if not all(getattr(query, 'read', True) for query in queries):
+            self.stick()  # workers write in copies of current context
+
+        try:
+            futures = [self.submit(func) for func in funcs]
+        except ImportError:  # no concurrent.futures (py2)
+            return self.gather_threads(funcs)
+        return [future.result() for future in futures]
+
+    def gather_threads(self, funcs):
+        # a thread per function, the errors are raised in order like futures'
+        results = [None] * len(funcs)
+        errors = [None] * len(funcs)
+
+        def run(idx, func):
+            try:
+                results[idx] = self.run_job(func)
+            except Exception as exc:
+                errors[idx] = exc
+
+        threads = [threading.Thread(target=run, args=(idx, func))
+                   for idx, func in enumerate(funcs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+    def execute_async(self, query):
+        if not query.read:
+            self.stick()
+        return self.dbapi.execute_async(self, query)
+
+    def stream_async(self, sql, size=1000):
+        return self.dbapi.stream_async(self, sql, size)
 
     def execute(self, *args):
-        cursor = self.dbapi.get_cursor(self.get_conn())
-        self.dbapi.execute_cursor(cursor, args)
+        return self.route(False).execute_args(args)
+
+    def execute_sql(self, sql, retry=False, read=False):  # a sql object
+        args = (sql.literal, sql.params)
+        database = self.route(read)
+
+        if not read and database.use_writer and not database.in_transaction():
+            return database.get_writer().execute(args)
+
+        try:
+            return database.execute_args(args, retry=retry)
+        except Exception as exc:
+            if not read or not isinstance(database, Replica) or \
+                    not self.dbapi.is_unavailable(exc):
+                raise  # writes are never executed again
+        # the replica is down, read again on another one (or primary)
+        return self.route(read, database).execute_args(args, retry=retry)
+
+    def execute_args(self, args, retry=False):
+        # retry: reconnect and execute again if the connection was lost,
+        # only for reads out of transactions. out of transactions, the
+        # connection is checked out for this statement only (its rows are
+        # read before it's given back).
+        try:
+            try:
+                cursor = self.dbapi.get_cursor(self.get_conn())
+                self.dbapi.execute_cursor(cursor, args)
+            except Exception as exc:
+                if not self.dbapi.is_disconnect(exc):
+                    raise
+                self.discard()
+                if not retry or self.in_transaction():
+                    raise
+                cursor = self.dbapi.get_cursor(self.get_conn())
+                self.dbapi.execute_cursor(cursor, args)
+            if not self.in_transaction():
+                cursor = self.dbapi.buffer_cursor(cursor)
+        finally:
+            if not self.in_transaction():
+                self.unbind()
         return cursor
 
-    def execute_sql(self, sql):  # execute a sql object
-        return self.execute(sql.literal, sql.params)
+    def stream_sql(self, sql, size=1000):
+        # yield rows of a select, fetched `size` rows at a time.
+        for rows in self.stream_chunks(sql, size=size):
+            for row in rows:
+                yield row
+
+    def stream_chunks(self, sql, size=1000):
+        # lists of at most `size` rows of a select, on a replica if any
+        return self.route(True).fetch_chunks(sql, size=size)
+
+    def fetch_chunks(self, sql, size=1000):
+        # yield lists of at most `size` rows of a select. out of
+        # transactions, a connection of its own is used, so other queries
+        # can be run while streaming.
+        pool = None
+
+        if not self.in_transaction():
+            pool = self.get_pool()
+            conn = pool.acquire()
+        else:
+            conn = self.get_conn()
+
+        try:
+            cursor = self.dbapi.get_stream_cursor(conn)
+            try:
+                self.dbapi.execute_cursor(cursor, (sql.literal, sql.params))
+                while True:
+                    rows = cursor.fetchmany(size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+        except Exception as exc:
+            if pool is not None and self.dbapi.is_disconnect(exc):
+                pool.close_conn(conn)
+            raise
+        finally:
+            if pool is not None:
+                pool.release(conn)
 
     def change(self, db):
-        return self.dbapi.select_db(db, self.conn, self.configs)
+        conn = self.conn
+        self.dbapi.select_db(db, conn, self.configs)
+
+        # pooled connections are still using the old database, keep only
+        # the current one (if still open) within a new pool
+        pool, self.pool = self.pool, None
+
+        if pool is not None:
+            state = pool.detach(conn)
+            pool.close()
+            if state is not None and self.dbapi.conn_is_open(conn):
+                self.get_pool().attach(conn, state)
+                self.bind(conn, self.pool)
 
     def set_autocommit(self, boolean):
+        for db in list(self.tenants.values()):
+            db.set_autocommit(boolean)
+
         self.autocommit = boolean
-        if self.dbapi.conn_is_open(self.conn):
+        if self.pool is not None:
+            self.pool.autocommit = boolean
+        if self._dbapi is not None and self.dbapi.conn_is_open(self.conn):
             return self.dbapi.set_autocommit(self.conn, boolean)
 
     def begin(self):
-        return self.dbapi.begin_transaction(self.conn)
+        db = self.current()
+        if db is not self:
+            return db.begin()
+        # queries go to primary till the end, nested transactions are
+        # savepoints
+        depth = getattr(self.local, 'transaction', 0)
+        conn = self.get_conn()
+        self.local.transaction = depth + 1
+        if depth:
+            return self.dbapi.savepoint(conn, 'skylark_%d' % depth)
+        if self.autocommit:  # else the connection is always in one
+            return self.dbapi.begin_transaction(conn)
 
     def commit(self):
-        return self.dbapi.commit_transaction(self.conn)
+        db = self.current()
+        if db is not self:
+            return db.commit()
+        depth = getattr(self.local, 'transaction', 0)
+        if getattr(self.local, 'aborted', False):
+            self.end_aborted(depth)
+            raise TransactionAborted
+        if depth > 1:
+            self.local.transaction = depth - 1
+            return self.dbapi.release_savepoint(
+                self.conn, 'skylark_%d' % (depth - 1))
+        self.local.transaction = 0
+        self.stick()
+        if self.conn is None:  # nothing was run
+            return None
+        try:
+            return self.dbapi.commit_transaction(self.conn)
+        finally:
+            if self.autocommit:
+                self.unbind()
 
     def rollback(self):
-        return self.dbapi.rollback_transaction(self.conn)
+        db = self.current()
+        if db is not self:
+            return db.rollback()
+        depth = getattr(self.local, 'transaction', 0)
+        if getattr(self.local, 'aborted', False):
+            return self.end_aborted(depth)  # rolled back with its connection
+        if depth > 1:
+            self.local.transaction = depth - 1
+            return self.dbapi.rollback_savepoint(
+                self.conn, 'skylark_%d' % (depth - 1))
+        self.local.transaction = 0
+        if self.conn is None:
+            return None
+        try:
+            return self.dbapi.rollback_transaction(self.conn)
+        finally:
+            if self.autocommit:
+                self.unbind()
+
+    def end_aborted(self, depth):  # a level of an aborted transaction
+        self.local.transaction = max(depth - 1, 0)
+        if not self.local.transaction:
+            self.local.aborted = False
 
     def transaction(self):
-        return Transaction(self)
+        return Transaction(self.current())
 
     select_db = change  # alias
 
 
+class Replica(DatabaseType):
+    # a read replica, tracks its latency and error rate (ewma) of queries
+    # and probes, it's ejected from routing while the error rate is high.
+
+    ewma_alpha = 0.2  # weight of the latest sample
+    max_error_rate = 0.5
+
+    def __init__(self, name):
+        super(Replica, self).__init__()
+        self.name = name
+        self.latency = 0.0  # seconds
+        self.error_rate = 0.0
+
+    @property
+    def healthy(self):
+        return self.error_rate <= self.max_error_rate
+
+    def record(self, latency=None):  # a sample, latency None for an error
+        alpha = self.ewma_alpha
+        if latency is None:
+            self.error_rate = alpha + (1 - alpha) * self.error_rate
+        else:
+            self.error_rate = (1 - alpha) * self.error_rate
+            self.latency = alpha * latency + (1 - alpha) * self.latency
+
+    def execute_args(self, args, retry=False):
+        start = _now()
+        try:
+            cursor = super(Replica, self).execute_args(args, retry=retry)
+        except Exception as exc:
+            if self.dbapi.is_unavailable(exc):
+                self.record(None)
+            raise
+        self.record(_now() - start)
+        return cursor
+
+    def probe(self):
+        # ping an idle connection (or a new one), skipped if all connections
+        # are in use.
+        pool = self.get_pool()
+        start = _now()
+
+        try:
+            conn = pool.acquire(wait=False)
+        except PoolTimeout:
+            return
+        except Exception:  # can't connect
+            self.record(None)
+            return
+
+        if self.dbapi.conn_is_alive(conn):
+            self.record(_now() - start)
+        else:
+            self.record(None)
+            pool.close_conn(conn)
+        pool.release(conn)  # a closed one is dropped
+
+
 database = Database = DatabaseType()
 
 
 class Transaction(object):
+    # `with database.transaction():` commits at the end, or rolls back if an
+    # exception escaped, nested ones are savepoints. as a decorator, each
+    # call of the function runs in a transaction.
 
     def __init__(self, database):
         self.database = database
+        self.active = False
 
     def begin(self):
+        self.active = True
         return self.database.begin()
 
     def commit(self):
+        self.active = False
         return self.database.commit()
 
     def rollback(self):
+        self.active = False
         return self.database.rollback()
 
     def __enter__(self):
@@ -326,7 +1488,270 @@ class Transaction(object):
         return self
 
     def __exit__(self, except_tp, except_val, trace):
-        return self.commit()
+        if not self.active:  # committed or rolled back within the block
+            return
+        if except_tp is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Transaction(self.database):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class Sharding(object):
+    # rows of a model spread over databases by the value of a field (the
+    # primarykey by default): hashed (modulo for integers), or in ranges
+    # split at sorted `bounds`, e.g. bounds=(1000, 2000) for 3 databases.
+    #
+    #   class User(Model):
+    #       name = Field()
+    #       sharding = Sharding([db1, db2])
+
+    def __init__(self, databases, key=None, bounds=None):
+        self.databases = list(databases)
+        self.key = key  # field name
+        self.bounds = bounds
+
+    def field(self, model):
+        if self.key is None:
+            return model.primarykey
+        return model.fields[self.key]
+
+    def locate(self, value):  # database of a shard key value
+        if self.bounds is not None:
+            return self.databases[bisect.bisect_right(self.bounds, value)]
+        return self.databases[_hash(value) % len(self.databases)]
+
+    def dbapi(self):  # connector of the shards, queries are compiled for
+        placeholders = set([db.dbapi.placeholder for db in self.databases])
+        if len(placeholders) > 1:
+            raise UnSupportedDBAPI  # shards with unlike connectors
+        return self.databases[0].dbapi
+
+    def route(self, type, runtime, model):
+        # databases a query runs on, every one if the query doesn't
+        # restrict the shard key
+        field = self.field(model)
+
+        if type == QUERY_INSERT:
+            for expr in runtime.data[RT_VL]:
+                if expr.left is field:
+                    return [self.locate(expr.right)]
+            raise ShardKeyNotFound
+
+        values = _restriction(field, runtime.data[RT_WH])[0]
+        if values is None:
+            return self.databases
+
+        databases = []
+        for value in values:
+            db = self.locate(value)
+            if db not in databases:
+                databases.append(db)
+        return databases
+
+
+def _routing_model(model):  # the model whose sharding routes a query
+    if not model.single:
+        return model.models[0]  # joined tables are sharded alike
+    return model
+
+
+def _hash(value):  # stable across processes, unlike hash()
+    if isinstance(value, integer_types):
+        return value
+    return zlib.crc32(('%s' % value).encode('utf8')) & 0xffffffff
+
+
+def _is_value(val):
+    return not isinstance(val, (Leaf, Query))
+
+
+def _restriction(field, conditions):
+    # what and-ed conditions tell about values of field: (values it equals
+    # or None, lower bound or None, upper bound or None), bounds inclusive.
+    values, low, high = None, None, None
+
+    for expr in conditions:
+        if not isinstance(expr, Expr):
+            continue
+
+        if expr.op_type == OP_AND:
+            _values, _low, _high = _restriction(
+                field, (expr.left, expr.right))
+        elif expr.left is not field:
+            continue
+        else:
+            _values, _low, _high = None, None, None
+            op, right = expr.op_type, expr.right
+
+            if op == OP_EQ and _is_value(right):
+                _values = [right]
+            elif op == OP_IN and all(map(_is_value, right)):
+                _values = list(right)
+            elif op in (OP_GT, OP_GE) and _is_value(right):
+                _low = right
+            elif op in (OP_LT, OP_LE) and _is_value(right):
+                _high = right
+            elif op == OP_BETWEEN and all(map(_is_value, right)):
+                _low, _high = right
+
+        if values is None:
+            values = _values
+        if _low is not None and (low is None or _low > low):
+            low = _low
+        if _high is not None and (high is None or _high < high):
+            high = _high
+    return values, low, high
+
+
+class Partitioning(object):
+    # rows of a model spread over tables named '<table_name>_<suffix>' by
+    # the value of field `key`. a query runs on the tables its where clause
+    # may match, selects on several tables read their union all.
+    #
+    #   class Event(Model):
+    #       created = Field()
+    #       partitioning = MonthPartitioning('created', date(2026, 1, 1))
+
+    def __init__(self, key):
+        self.key = key  # field name
+
+    def field(self, model):
+        return model.fields[self.key]
+
+    def suffix(self, value):  # partition of a key value
+        raise NotImplementedError
+
+    def suffixes(self, values, low, high):
+        # partitions that may hold the values, or values within the bounds
+        raise NotImplementedError
+
+    def table(self, model, suffix):
+        return '%s_%s' % (model.table_name, suffix)
+
+    def runtimes(self, type, runtime):
+        # runtimes of a query with tables of partitions in place of the
+        # model, updates and deletes get one for each table
+        model = runtime.model
+        field = self.field(model)
+
+        if type == QUERY_INSERT:
+            for expr in runtime.data[RT_VL]:
+                if expr.left is field:
+                    table = self.table(model, self.suffix(expr.right))
+                    return [runtime.set_tg(
+                        [Partitions(model, [table], alias=False)])]
+            raise PartitionKeyNotFound
+
+        conditions = runtime.data[RT_WH]
+        suffixes = self.suffixes(*_restriction(field, conditions))
+        if not suffixes:  # nothing can match, still a valid query
+            suffixes = self.suffixes(None, None, None)[:1]
+        tables = [self.table(model, suffix) for suffix in suffixes]
+
+        if type == QUERY_SELECT:
+            # conditions on the key are pushed down into each table
+            conditions = [expr for expr in conditions
+                          if isinstance(expr, Expr) and expr.left is field]
+            return [runtime.set_fm([Partitions(model, tables, conditions)])]
+        if type == QUERY_UPDATE:
+            return [runtime.set_tg([Partitions(model, [table])])
+                    for table in tables]
+        return [runtime.set_fm([Partitions(model, [table])])
+                for table in tables]
+
+
+class HashPartitioning(Partitioning):
+    # `buckets` tables, e.g. event_0 .. event_7
+
+    def __init__(self, key, buckets):
+        super(HashPartitioning, self).__init__(key)
+        self.buckets = buckets
+
+    def suffix(self, value):
+        return '%d' % (_hash(value) % self.buckets)
+
+    def suffixes(self, values, low, high):
+        if values is not None:
+            return sorted(set(map(self.suffix, values)), key=int)
+        return ['%d' % i for i in range(self.buckets)]
+
+
+class MonthPartitioning(Partitioning):
+    # a table a month (of dates or datetimes), e.g. event_202610, from the
+    # month of `start` to the month of `end` (defaults to current month),
+    # rows out of these months can't be inserted.
+
+    def __init__(self, key, start, end=None):
+        super(MonthPartitioning, self).__init__(key)
+        self.start = (start.year, start.month)
+        self.end = None if end is None else (end.year, end.month)
+
+    def months(self):  # first and last months with a table
+        if self.end is not None:
+            return self.start, self.end
+        now = time.localtime()
+        return self.start, (now.tm_year, now.tm_mon)
+
+    def suffix(self, value):
+        first, last = self.months()
+        if not first <= (value.year, value.month) <= last:
+            raise PartitionNotFound
+        return '%04d%02d' % (value.year, value.month)
+
+    def suffixes(self, values, low, high):
+        first, last = self.months()
+
+        if values is not None:
+            months = set((value.year, value.month) for value in values)
+            return ['%04d%02d' % month for month in sorted(months)
+                    if first <= month <= last]
+
+        if low is not None:
+            first = max(first, (low.year, low.month))
+        if high is not None:
+            last = min(last, (high.year, high.month))
+
+        suffixes = []
+        year, month = first
+        while (year, month) <= last:
+            suffixes.append('%04d%02d' % (year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return suffixes
+
+
+class Partitions(object):
+    # tables of a partitioned model in a query, in place of the model: one
+    # table, or the union all of several (with conditions on the key pushed
+    # down), aliased as the model's table so fields can still refer to it.
+
+    def __init__(self, model, tables, conditions=(), alias=True):
+        self.model = model
+        self.tables = tables
+        self.conditions = conditions
+        self.alias = alias  # False for insert
+
+
+class Tenant(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = self.database.tenant_name.get()
+        self.database.tenant_name.set(self.name)
+        return self.database.get_tenant(self.name)
+
+    def __exit__(self, except_tp, except_val, trace):
+        self.database.tenant_name.set(self.previous)
 
 
 class Leaf(object):
@@ -381,6 +1806,9 @@ class Leaf(object):
         return func
 
 
+_parentheses = re.compile(r'[()]')
+
+
 class SQL(Leaf):
 
     def __init__(self, literal, *params):
@@ -393,7 +1821,7 @@ class SQL(Leaf):
     @classmethod
     def format(cls, spec, *args):
         literal = spec % tuple(arg.literal for arg in args)
-        params = sum([arg.params for arg in args], tuple())
+        params = [param for arg in args for param in arg.params]
         return cls(literal, *params)
 
     @classmethod
@@ -401,40 +1829,38 @@ class SQL(Leaf):
         # seq maybe a generator, so cast it static to iter twice
         seq = tuple(seq)
         literal = sptr.join(sql.literal for sql in seq)
-        params = sum([sql.params for sql in seq], tuple())
+        params = [param for sql in seq for param in sql.params]
         return cls(literal, *params)
 
     def normalize(self):
         # let sql literal behave normal
-        self.literal = ' '.join(self.literal.split())  # remove spaces
-        # remove unnecessary parentheses
-        size = len(self.literal)
-        count = 0
-        pairs = []
-
-        for p in range(size):
-            if self.literal[p] != '(':
-                continue
-            for q in range(p, size):
-                if self.literal[q] == '(':
-                    count += 1
-                if self.literal[q] == ')':
-                    count -= 1
-                if count == 0:
-                    break
-            if count != 0:
-                raise SQLSyntaxError  # unbalanced '()'
-            pairs.append((p, q))
-
-        blacklist = []
-
-        for p, q in pairs:
-            if (p + 1, q - 1) in pairs:
-                blacklist.append(p)
-                blacklist.append(q)
-
-        self.literal = ''.join(v for k, v in enumerate(self.literal)
-                               if k not in blacklist)
+        literal = ' '.join(self.literal.split())  # remove spaces
+        # remove unnecessary parentheses, '((x))' => '(x)', in linear time
+        stack = []
+        pairs = {}  # index of '(' => index of matched ')'
+
+        for match in _parentheses.finditer(literal):
+            if match.group() == '(':
+                stack.append(match.start())
+            elif stack:
+                pairs[stack.pop()] = match.start()
+
+        if stack:
+            raise SQLSyntaxError  # unbalanced '()'
+
+        blacklist = set()
+
+        for p, q in pairs.items():
+            if pairs.get(p + 1) == q - 1:
+                blacklist.add(p)
+                blacklist.add(q)
+
+        if blacklist:
+            chars = list(literal)
+            for k in blacklist:
+                chars[k] = ''
+            literal = ''.join(chars)
+        self.literal = literal
 
 
 sql = SQL
@@ -537,21 +1963,92 @@ distinct = Distinct
 
 class Query(object):
 
+    retry = False  # retry on a lost connection
+    read = False  # may run on a read replica
+
     def __init__(self, type, runtime):
         self.type = type
-        self.sql = compiler.compile(self.type, runtime)
-        runtime.reset_data()
+
+        model = _routing_model(runtime.model)
+        sharding = getattr(model, 'sharding', None)
+        if sharding is None:
+            self.databases = [database]
+            self.dbapi = None  # of `database`
+        else:
+            self.databases = sharding.route(type, runtime, model)
+            self.dbapi = sharding.dbapi()
+
+        self.sqls = self.compile(runtime)
+        self.sql = self.sqls[0]
+
+    def compile(self, runtime):  # one statement, or one per partition
+        model = runtime.model
+        partitioning = getattr(model, 'partitioning', None)
+
+        if not model.single or partitioning is None:
+            return [compiler.compile(self.type, runtime, self.dbapi)]
+        return [compiler.compile(self.type, rt, self.dbapi)
+                for rt in partitioning.runtimes(self.type, runtime)]
+
+    def execute(self):
+        jobs = [(db, sql) for db in self.databases for sql in self.sqls]
+
+        if len(jobs) == 1:
+            return self.execute_on(*jobs[0])
+        # on every shard (and partition) at the same time, then merge.
+        # in a transaction of a shard, one by one on its connection.
+        if any(db.current().in_transaction() for db in self.databases):
+            return self.merge([self.execute_on(db, sql) for db, sql in jobs])
+        return self.merge(database.gather(*[
+            lambda db=db, sql=sql: db.run_job(self.execute_on, db, sql)
+            for db, sql in jobs]))
+
+    def execute_on(self, db, sql=None):
+        return self.result(db.execute_sql(
+            sql or self.sql, retry=self.retry, read=self.read))
+
+    def merge(self, results):  # rows affected
+        return sum(results)
+
+    def execute_async(self):
+        # awaitable of the result of execute(), `await query.execute_async()`
+        return database.execute_async(self)
 
 
 class InsertQuery(Query):
 
     def __init__(self, runtime):
+        self.rows = 1 + len(runtime.data[RT_RW])
+        self.ids = None  # primarykey values given in a multi-rows insert
+
+        if self.rows > 1:
+            model = runtime.data[RT_TG][0]
+            for idx, expr in enumerate(runtime.data[RT_VL]):
+                if expr.left is model.primarykey:
+                    self.ids = [expr.right] + [
+                        row[idx] for row in runtime.data[RT_RW]]
         super(InsertQuery, self).__init__(QUERY_INSERT, runtime)
 
-    def execute(self):
-        cursor = database.execute_sql(self.sql)
+    def execute_on(self, db, sql=None):  # ids by the connector of `db`
+        return self.result(db.execute_sql(
+            sql or self.sql, retry=self.retry, read=self.read), db.dbapi)
+
+    def result(self, cursor, dbapi=None):
+        # multi-rows insert returns ids of inserted rows
         last_insert_id = cursor.lastrowid
         rows_affected = cursor.rowcount
+
+        if self.rows > 1:
+            ids = None
+            if rows_affected == self.rows:
+                if self.ids is not None:
+                    ids = self.ids
+                elif last_insert_id:
+                    dbapi = dbapi or database.dbapi
+                    ids = dbapi.inserted_ids(cursor, self.rows)
+            cursor.close()
+            return ids
+
         cursor.close()
         if rows_affected:
             return last_insert_id
@@ -562,8 +2059,7 @@ class UpdateQuery(Query):
     def __init__(self, runtime):
         super(UpdateQuery, self).__init__(QUERY_UPDATE, runtime)
 
-    def execute(self):
-        cursor = database.execute_sql(self.sql)
+    def result(self, cursor):
         rows_affected = cursor.rowcount
         cursor.close()
         return rows_affected
@@ -571,29 +2067,204 @@ class UpdateQuery(Query):
 
 class SelectQuery(Query):
 
+    retry = True
+    read = True
+
     def __init__(self, runtime):
         self.model = runtime.model
         self.nodes = runtime.data[RT_SL]
+        self.order = runtime.data[RT_OD]
+        self.limit = runtime.data[RT_LM]
         super(SelectQuery, self).__init__(QUERY_SELECT, runtime)
 
-    def execute(self):
-        cursor = database.execute_sql(self.sql)
+        if len(self.databases) > 1 and self.order and SelectResult(
+                (), self.model, self.nodes).index_of(self.order[0]) is None:
+            # rows of shards are merged in order by the selected values
+            raise SkylarkException(
+                'orderby field must be selected to merge rows of shards')
+
+        if len(self.databases) > 1 and self.limit and self.limit[0]:
+            # offset applies to the merged rows, shards return them all
+            offset, rows = self.limit
+            self.sqls = self.compile(runtime.set_lm((None, offset + rows)))
+            self.sql = self.sqls[0]
+
+    def result(self, cursor):
         result = SelectResult(tuple(cursor.fetchall()), self.model, self.nodes)
         cursor.close()
         return result
 
+    def merge(self, results):
+        # rows of shards: aggregates combined, ordered, then limited
+        rows = [row for result in results for row in result.rows]
+        result = SelectResult((), self.model, self.nodes)
+        aggregates = result.aggregates()
+
+        if aggregates:
+            groups = {}
+            for row in rows:
+                key = tuple([v for i, v in enumerate(row)
+                             if i not in aggregates])
+                if key in groups:
+                    groups[key] = tuple([
+                        aggregates[i](a, b) if i in aggregates else a
+                        for i, (a, b) in enumerate(zip(groups[key], row))])
+                else:
+                    groups[key] = row
+            rows = list(groups.values())
+
+        if self.order:
+            field, desc = self.order
+            idx = result.index_of(field)
+            rows.sort(key=lambda row: (row[idx] is not None, row[idx]),
+                      reverse=desc)
+
+        if self.limit:
+            offset, count = self.limit
+            offset = offset or 0
+            rows = rows[offset:offset + count]
+        return SelectResult(tuple(rows), self.model, self.nodes)
+
     def __iter__(self):
         result = self.execute()
         return iter(result.all())
 
+    def iterator(self, size=1000, mode='models'):
+        # stream rows in chunks of `size` (server side cursor on mysql) and
+        # convert them one by one (see SelectResult.converter for modes),
+        # memory stays bounded by `size`.
+        convert = SelectResult((), self.model, self.nodes).converter(mode)
+        for rows in self.stream_chunks(size):
+            for row in rows:
+                yield convert(row)
+
+    def stream_chunks(self, size):
+        if len(self.databases) == 1:
+            for rows in self.databases[0].stream_chunks(self.sql, size=size):
+                yield rows
+            return
+
+        result = SelectResult((), self.model, self.nodes)
+        if result.aggregates():  # combined over all rows of the shards
+            rows = self.execute().rows
+            for start in range(0, len(rows), size):
+                yield list(rows[start:start + size])
+            return
+
+        # rows of the shards merged in order, then limited
+        streams = [db.stream_sql(self.sql, size=size)
+                   for db in self.databases]
+        try:
+            rows = self.merge_streams(streams, result)
+            if self.limit:
+                offset, count = self.limit
+                offset = offset or 0
+                rows = islice(rows, offset, offset + count)
+
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def merge_streams(self, streams, result):
+        # k-way merge of rows of shards, each ordered by the orderby field
+        idx = None
+        if self.order:
+            field, desc = self.order
+            idx = result.index_of(field)
+
+        if idx is None:  # not ordered
+            for stream in streams:
+                for row in stream:
+                    yield row
+            return
+
+        key = lambda head: (head[0][idx] is not None, head[0][idx])
+        pick = max if desc else min
+        heads = []  # [row, stream]
+        for stream in streams:
+            for row in stream:
+                heads.append([row, stream])
+                break
+
+        while heads:
+            head = pick(heads, key=key)
+            yield head[0]
+            for row in head[1]:
+                head[0] = row
+                break
+            else:
+                heads = [h for h in heads if h is not head]
+
+    def aiterator(self, size=1000, mode='models'):
+        # async version of iterator: `async for user in query.aiterator()`
+        convert = SelectResult((), self.model, self.nodes).converter(mode)
+        if len(self.databases) == 1:
+            next_chunk = self.databases[0].stream_async(self.sql, size)
+        else:
+            chunks = self.stream_chunks(size)
+            next_chunk = lambda: database.run_async(next, chunks, ())
+        return AsyncIterator(next_chunk, convert)
+
+    def __aiter__(self):
+        return self.aiterator()
+
+    def columns(self, size=1000, numpy=False):
+        # fetch the result column by column, `size` rows at a time, into
+        # array.array for numeric columns and lists for the others.
+        result = SelectResult((), self.model, self.nodes)
+        columns = Columns(result.column_names())
+        for rows in self.stream_chunks(size):
+            columns.extend(rows)
+        return columns.todict(numpy=numpy)
+
+
+class AsyncIterator(object):
+    # rows for `async for`, awaited chunk by chunk from `next_chunk()`
+
+    def __init__(self, next_chunk, convert):
+        self.next_chunk = next_chunk
+        self.convert = convert
+        self.rows = iter(())
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio  # py3.4+
+        future = asyncio.get_event_loop().create_future()
+
+        for row in self.rows:  # buffered
+            future.set_result(self.convert(row))
+            return future
+
+        def fetched(chunk):
+            try:
+                rows = chunk.result()
+                if not rows:
+                    raise StopAsyncIteration  # py3.5+
+                self.rows = iter(rows)
+                future.set_result(self.convert(next(self.rows)))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+        asyncio.ensure_future(self.next_chunk()).add_done_callback(fetched)
+        return future
+
 
 class DeleteQuery(Query):
 
     def __init__(self, runtime):
         super(DeleteQuery, self).__init__(QUERY_DELETE, runtime)
 
-    def execute(self):
-        cursor = database.execute_sql(self.sql)
+    def result(self, cursor):
         rows_affected = cursor.rowcount
         cursor.close()
         return rows_affected
@@ -610,39 +2281,302 @@ class SelectResult(object):
 
         # distinct should be the first select node if it exists
         if nodes and isinstance(nodes[0], Distinct):
-            nodes = list(nodes[0].args) + nodes[1:]
+            nodes = tuple(nodes[0].args) + tuple(nodes[1:])
         self.nodes = nodes
 
-    def inst(self, model, row):
-        inst = model()
-        inst.set_in_db(True)
+        if model.single:
+            self.plans = [self.plan(model)]
+        else:
+            self.plans = [self.plan(m) for m in model.models]
+
+    def plan(self, model):
+        # how to build an instance of model from a row, computed once a query:
+        # (model, field names, getter of their values, (index, alias) pairs,
+        #  names of fields and aliases, getter of their values)
+        names, idxs, aliases = [], [], []
 
         for idx, node in enumerate(self.nodes):
-            if isinstance(node, Field) and node.model is model:
-                inst[node.name] = row[idx]
-            if isinstance(node, Alias) and isinstance(node.inst, Field) \
+            if isinstance(node, Field):
+                if node.model is model:
+                    names.append(node.name)
+                    idxs.append(idx)
+            elif isinstance(node, Alias) and isinstance(node.inst, Field) \
                     and node.inst.model is model:
-                setattr(inst, node.name, row[idx])
+                aliases.append((idx, node.name))
+
+        keys = tuple(names + [name for idx, name in aliases])
+        values = _getter(idxs + [idx for idx, name in aliases])
+        return (model, tuple(names), _getter(idxs), tuple(aliases),
+                keys, values)
+
+    def build(self, plan, row):
+        model, names, getter, aliases = plan[:4]
+        inst = model()
+        inst.set_in_db(True)
+        dict.update(inst, zip(names, getter(row)))
+
+        for idx, name in aliases:
+            setattr(inst, name, row[idx])
         return inst
 
-    def __one(self, row):
+    def inst(self, model, row):
+        return self.build(self.plan(model), row)
+
+    def hydrate(self, row):
         if self.model.single:
-            return self.inst(self.model, row)
-        return tuple(map(lambda m: self.inst(m, row), self.model.models))
+            return self.build(self.plans[0], row)
+        return tuple([self.build(plan, row) for plan in self.plans])
+
+    def converter(self, mode):
+        # function converting a row for a mode: 'models', 'tuples', 'dicts',
+        # 'namedtuples', 'records' or 'scalars'. only 'models' builds model
+        # instances, others are read-only rows without tracking state.
+        if mode == 'models':
+            return self.hydrate
+        if mode == 'tuples':
+            return lambda row: row
+        if mode == 'scalars':
+            return itemgetter(0)
+
+        if mode == 'dicts':
+            makers = [lambda values, keys=plan[4]: dict(zip(keys, values))
+                      for plan in self.plans]
+        elif mode == 'namedtuples':
+            makers = [self.row_class(plan, namedtuple_class)._make
+                      for plan in self.plans]
+        elif mode == 'records':
+            makers = [self.row_class(plan, record_class)
+                      for plan in self.plans]
+        else:
+            raise ValueError('unknown result mode %r' % mode)
+
+        pairs = [(maker, plan[5]) for maker, plan in zip(makers, self.plans)]
+
+        if self.model.single:
+            maker, values = pairs[0]
+            return lambda row: maker(values(row))
+        return lambda row: tuple([maker(values(row))
+                                  for maker, values in pairs])
+
+    def row_class(self, plan, factory):
+        model, keys = plan[0], plan[4]
+        key = (factory, model, keys)
+
+        if key not in self.row_classes:
+            self.row_classes[key] = factory(model.__name__, keys)
+        return self.row_classes[key]
+
+    row_classes = {}  # cache of generated classes by (factory, model, keys)
 
     def one(self):
         try:
             row = next(self._rows)  # py2.6+/3.0+
         except StopIteration:
             return None
-        return self.__one(row)
+        return self.hydrate(row)
 
     def all(self):
-        return tuple(map(self.__one, self.rows))
+        return tuple(map(self.hydrate, self.rows))
 
     def tuples(self):
         return self.rows
 
+    def dicts(self):
+        return tuple(map(self.converter('dicts'), self.rows))
+
+    def namedtuples(self):
+        return tuple(map(self.converter('namedtuples'), self.rows))
+
+    def records(self):
+        return tuple(map(self.converter('records'), self.rows))
+
+    def scalars(self):
+        # values of the first column, for single column selects
+        return tuple(map(itemgetter(0), self.rows))
+
+    def index_of(self, field):  # index of a selected field, or None
+        for idx, node in enumerate(self.nodes):
+            if node is field or isinstance(node, Alias) and node.inst is field:
+                return idx
+        return None
+
+    def aggregates(self):
+        # index => function combining two values, of aggregate columns
+        aggregates = {}
+
+        for idx, node in enumerate(self.nodes):
+            if isinstance(node, Alias):
+                node = node.inst
+            if isinstance(node, Function):
+                name = node.name.lower()
+                if name in _combiners:
+                    aggregates[idx] = _combiners[name]
+                elif name == 'avg':
+                    raise SkylarkException(
+                        'avg can\'t be merged across shards')
+        return aggregates
+
+    def column_names(self):
+        names = []
+
+        for node in self.nodes:
+            if isinstance(node, Field):
+                names.append(node.name if self.model.single else node.fullname)
+            elif isinstance(node, Alias):
+                names.append(node.name)
+            else:
+                names.append(compiler.sql(node).literal)
+        return names
+
+    def columns(self, numpy=False):
+        # dict of column name => array.array for numeric columns, list for
+        # the others, or numpy.ndarray for all if `numpy`.
+        columns = Columns(self.column_names())
+        columns.extend(self.rows)
+        return columns.todict(numpy=numpy)
+
+    def ndarray(self):
+        # numpy structured array, with a named field for each column
+        columns = Columns(self.column_names())
+        columns.extend(self.rows)
+        return columns.ndarray()
+
+
+def _combine(func):  # sql aggregates skip nulls
+    def combine(a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return func(a, b)
+    return combine
+
+
+_combiners = {
+    'count': _combine(lambda a, b: a + b),
+    'sum': _combine(lambda a, b: a + b),
+    'max': _combine(max),
+    'min': _combine(min),
+}
+
+
+def _getter(idxs):  # function picking values at idxs from a row, as a tuple
+    if len(idxs) == 1:
+        idx = idxs[0]
+        return lambda row: (row[idx], )
+    elif idxs:
+        return itemgetter(*idxs)
+    return lambda row: ()
+
+
+try:
+    array('q')
+    INT_TYPECODE = 'q'
+except ValueError:  # py2
+    INT_TYPECODE = 'l'
+
+
+class Columns(object):
+    # per column buffers of a result, filled chunk by chunk. a column is an
+    # array.array while its values fit in the typecode of its first value
+    # (int or float), a list otherwise.
+
+    def __init__(self, names):
+        self.names = names
+        self.buffers = None
+
+    def extend(self, rows):
+        if not rows:
+            return
+
+        values = list(zip(*rows))
+
+        if self.buffers is None:
+            self.buffers = [self.create(col) for col in values]
+            return
+
+        for idx, col in enumerate(values):
+            buf = self.buffers[idx]
+            if isinstance(buf, array):
+                try:
+                    buf.extend(array(buf.typecode, col))
+                    continue
+                except (TypeError, OverflowError):
+                    buf = self.buffers[idx] = buf.tolist()
+            buf.extend(col)
+
+    def create(self, col):
+        first = col[0]
+
+        if isinstance(first, float):
+            typecode = 'd'
+        elif isinstance(first, integer_types) and not isinstance(first, bool):
+            typecode = INT_TYPECODE
+        else:
+            return list(col)
+
+        try:
+            return array(typecode, col)
+        except (TypeError, OverflowError):
+            return list(col)
+
+    def todict(self, numpy=False):
+        buffers = self.buffers or [[] for name in self.names]
+        if numpy:
+            buffers = list(map(self.toarray, buffers))
+        return dict(zip(self.names, buffers))
+
+    def toarray(self, buf):
+        import numpy  # optional
+        if isinstance(buf, array):
+            return numpy.frombuffer(buf, dtype=buf.typecode)
+        return numpy.array(buf)
+
+    def ndarray(self):
+        import numpy  # optional
+        buffers = self.buffers or [[] for name in self.names]
+        return numpy.rec.fromarrays(list(map(self.toarray, buffers)),
+                                    names=self.names)
+
+
+def namedtuple_class(name, keys):
+    return namedtuple(name + 'Row', keys)
+
+
+class Record(object):
+    # read-only row with a slot for each selected field
+
+    __slots__ = ()
+    setters = ()  # __set__ of the slots, they bypass __setattr__
+
+    def __init__(self, values):
+        for setter, val in zip(self.setters, values):
+            setter(self, val)
+
+    def __setattr__(self, key, val):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __iter__(self):
+        return iter([getattr(self, key) for key in self.__slots__])
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (key, getattr(self, key)) for key in self.__slots__))
+
+
+def record_class(name, keys):
+    cls = type(name + 'Record', (Record, ), {'__slots__': keys})
+    cls.setters = tuple(cls.__dict__[key].__set__ for key in keys)
+    return cls
+
 
 class Compiler(object):
 
@@ -657,7 +2591,7 @@ class Compiler(object):
         OP_SUB: '-',
         OP_MUL: '*',
         OP_DIV: '/',
-        OP_MOD: '%%',  # escape '%'
+        OP_MOD: '%',
         OP_AND: 'and',
         OP_OR: 'or',
         OP_LIKE: 'like',
@@ -666,50 +2600,80 @@ class Compiler(object):
         OP_NOT_IN: 'not in',
     }
 
-    def sql2sql(sql):
-        return sql
+    # *2sql: write a node's literal pieces into parts and its values into
+    # params, a query is compiled within one tree walk into the two lists.
 
-    def query2sql(query):
-        return sql.format('(%s)', query.sql)
+    def sql2sql(sql, parts, params):
+        parts.append(sql.literal)
+        params.extend(sql.params)
 
-    def alias2sql(alias):
-        spec = '%%s as %s' % alias.name
-        return sql.format(spec, compiler.sql(alias.inst))
+    def query2sql(query, parts, params):
+        parts.append('(')
+        compiler.write(query.sql, parts, params)
+        parts.append(')')
 
-    def field2sql(field):
-        return sql(field.fullname)
+    def alias2sql(alias, parts, params):
+        compiler.write(alias.inst, parts, params)
+        parts.append(' as ')
+        parts.append(alias.name)
 
-    def function2sql(function):
-        spec = '%s(%%s)' % function.name
-        args = sql.join(', ', map(compiler.sql, function.args))
-        return sql.format(spec, args)
+    def field2sql(field, parts, params):
+        parts.append(field.fullname)
 
-    def distinct2sql(distinct):
-        args = sql.join(', ', map(compiler.sql, distinct.args))
-        return sql.format('distinct(%s)', args)
+    def partitions2sql(partitions, parts, params):
+        name = partitions.model.table_name
 
-    def expr2sql(expr):
+        if len(partitions.tables) == 1:
+            parts.append(partitions.tables[0])
+        else:
+            parts.append('(')
+            for idx, table in enumerate(partitions.tables):
+                if idx:
+                    parts.append(' union all ')
+                parts.append('select * from %s as %s' % (table, name))
+                if partitions.conditions:
+                    parts.append(' where ')
+                    compiler.write_join(
+                        ' and ', partitions.conditions, parts, params)
+            parts.append(')')
+
+        if partitions.alias:
+            parts.append(' as %s' % name)
+
+    def function2sql(function, parts, params):
+        parts.append(function.name)
+        parts.append('(')
+        compiler.write_join(', ', function.args, parts, params)
+        parts.append(')')
+
+    def distinct2sql(distinct, parts, params):
+        parts.append('distinct(')
+        compiler.write_join(', ', distinct.args, parts, params)
+        parts.append(')')
+
+    def expr2sql(expr, parts, params):
         if expr.op_str is None:
             op_str = compiler.mappings[expr.op_type]
         else:
             op_str = expr.op_str
 
-        left = compiler.sql(expr.left)
+        if expr.op_type in (OP_AND, OP_OR):
+            parts.append('(')
+
+        compiler.write(expr.left, parts, params)
+        parts.append(' %s ' % op_str)
 
         if expr.op_type < 100:  # common ops
-            right = compiler.sql(expr.right)
+            compiler.write(expr.right, parts, params)
         elif expr.op_type is OP_BETWEEN:
-            right = sql.join(' and ', map(compiler.sql, expr.right))
+            compiler.write_join(' and ', expr.right, parts, params)
         elif expr.op_type in (OP_IN, OP_NOT_IN):
-            vals = sql.join(', ', map(compiler.sql, expr.right))
-            right = sql.format('(%s)', vals)
-
-        spec = '%%s %s %%s' % op_str
+            parts.append('(')
+            compiler.write_join(', ', expr.right, parts, params)
+            parts.append(')')
 
         if expr.op_type in (OP_AND, OP_OR):
-            spec = '(%s)' % spec
-
-        return sql.format(spec, left, right)
+            parts.append(')')
 
     conversions = {
         SQL: sql2sql,
@@ -720,6 +2684,7 @@ class Compiler(object):
         ForeignKey: field2sql,
         Function: function2sql,
         Distinct: distinct2sql,
+        Partitions: partitions2sql,
         Query: query2sql,
         InsertQuery: query2sql,
         UpdateQuery: query2sql,
@@ -727,73 +2692,203 @@ class Compiler(object):
         DeleteQuery: query2sql
     }
 
-    def sql(self, inst):
+    @property
+    def placeholder(self):  # of the connector compiled for
+        dbapi = getattr(self.local, 'dbapi', None) or database.dbapi
+        return dbapi.placeholder
+
+    def write(self, inst, parts, params):
         tp = type(inst)
         if tp in self.conversions:
-            return self.conversions[tp](inst)
-        return sql(database.dbapi.placeholder, inst)
+            self.conversions[tp](inst, parts, params)
+        else:
+            parts.append(self.placeholder)
+            params.append(inst)
 
-    def jn2sql(lst):
-        prefix, main, join, expr = lst
+    def write_join(self, sptr, seq, parts, params):
+        for idx, inst in enumerate(seq):
+            if idx:
+                parts.append(sptr)
+            self.write(inst, parts, params)
+
+    def sql(self, inst):
+        parts, params = [], []
+        self.write(inst, parts, params)
+        return sql(''.join(parts), *params)
+
+    # *2key: the shape of a node, which decides its compiled literal, values
+    # are collected into params in the order they would be compiled.
+
+    def sql2key(sql, params):
+        params.extend(sql.params)
+        return (SQL, sql.literal)
+
+    def query2key(query, params):
+        params.extend(query.sql.params)
+        return (Query, query.sql.literal)
+
+    def alias2key(alias, params):
+        return (Alias, alias.name, compiler.key(alias.inst, params))
+
+    def field2key(field, params):
+        return (Field, field.fullname)
+
+    def partitions2key(partitions, params):
+        conditions = tuple([compiler.key(expr, params)
+                            for expr in partitions.conditions])
+        return (Partitions, partitions.model.table_name,
+                tuple(partitions.tables), conditions, partitions.alias)
+
+    def function2key(function, params):
+        args = tuple([compiler.key(arg, params) for arg in function.args])
+        return (Function, function.name, args)
+
+    def distinct2key(distinct, params):
+        args = tuple([compiler.key(arg, params) for arg in distinct.args])
+        return (Distinct, args)
+
+    def expr2key(expr, params):
+        left = compiler.key(expr.left, params)
+
+        if expr.op_type < 100:  # common ops
+            right = compiler.key(expr.right, params)
+        else:
+            right = tuple([compiler.key(val, params) for val in expr.right])
+        return (Expr, expr.op_type, expr.op_str, left, right)
+
+    key_conversions = {
+        SQL: sql2key,
+        Expr: expr2key,
+        Alias: alias2key,
+        Field: field2key,
+        PrimaryKey: field2key,
+        ForeignKey: field2key,
+        Function: function2key,
+        Distinct: distinct2key,
+        Partitions: partitions2key,
+        Query: query2key,
+        InsertQuery: query2key,
+        UpdateQuery: query2key,
+        SelectQuery: query2key,
+        DeleteQuery: query2key
+    }
+
+    def key(self, inst, params):
+        tp = type(inst)
+        if tp in self.key_conversions:
+            return self.key_conversions[tp](inst, params)
+        params.append(inst)
+        return None  # a placeholder
 
-        prefix = '' if prefix is None else '%s ' % prefix
+    def jn2sql(lst, parts, params):
+        prefix, main, join, expr = lst
 
         if expr is None:
             foreignkey = _detect_bridge(main, join)
             expr = foreignkey == foreignkey.reference
 
-        spec = '%sjoin %s on %%s' % (prefix, join.table_name)
-        return sql.format(spec, compiler.sql(expr))
+        if prefix is not None:
+            parts.append('%s ' % prefix)
+        parts.append('join %s on ' % join.table_name)
+        compiler.write(expr, parts, params)
 
-    def od2sql(lst):
+    def od2sql(lst, parts, params):
         node, desc = lst
-        spec = 'order by %%s%s' % (' desc' if desc else '')
-        return sql.format(spec, compiler.sql(node))
+        parts.append('order by ')
+        compiler.write(node, parts, params)
+        if desc:
+            parts.append(' desc')
 
-    def gp2sql(lst):
-        spec = 'group by %s'
-        arg = sql.join(', ', map(compiler.sql, lst))
-        return sql.format(spec, arg)
+    def gp2sql(lst, parts, params):
+        parts.append('group by ')
+        compiler.write_join(', ', lst, parts, params)
 
-    def hv2sql(lst):
-        spec = 'having %s'
-        arg = sql.join(' and ', map(compiler.sql, lst))
-        return sql.format(spec, arg)
+    def hv2sql(lst, parts, params):
+        parts.append('having ')
+        compiler.write_join(' and ', lst, parts, params)
 
-    def wh2sql(lst):
-        spec = 'where %s'
-        arg = sql.join(' and ', map(compiler.sql, lst))
-        return sql.format(spec, arg)
+    def wh2sql(lst, parts, params):
+        parts.append('where ')
+        compiler.write_join(' and ', lst, parts, params)
 
-    def sl2sql(lst):
-        return sql.join(', ', map(compiler.sql, lst))
+    def sl2sql(lst, parts, params):
+        compiler.write_join(', ', lst, parts, params)
 
-    def lm2sql(lst):
+    def lm2sql(lst, parts, params):
         offset, rows = lst
-        literal = 'limit %s%s' % (
-            '%s, ' % offset if offset is not None else '', rows)
-        return sql(literal)
+        parts.append('limit %s%s' % (
+            '%s, ' % offset if offset is not None else '', rows))
 
-    def st2sql(lst):
-        pairs = [
-            sql.format('%s=%%s' % expr.left.name, compiler.sql(expr.right))
-            for expr in lst]
-        return sql.join(', ', pairs)
+    def st2sql(lst, parts, params):
+        for idx, expr in enumerate(lst):
+            parts.append('%s%s=' % (', ' if idx else '', expr.left.name))
+            compiler.write(expr.right, parts, params)
 
-    def vl2sql(lst):
+    def vl2sql(lst, parts, params):
         keys = ', '.join([expr.left.name for expr in lst])
-        vals = map(compiler.sql, [expr.right for expr in lst])
-        spec = '(%s) values (%%s)' % keys
-        arg = sql.join(', ', vals)
-        return sql.format(spec, arg)
+        parts.append('(%s) values (' % keys)
+        compiler.write_join(', ', [expr.right for expr in lst], parts, params)
+        parts.append(')')
+
+    def rw2sql(lst, parts, params):  # more rows to insert
+        for row in lst:
+            parts.append(', (')
+            compiler.write_join(', ', row, parts, params)
+            parts.append(')')
+
+    def tables2sql(lst, parts, params):  # target, from
+        for idx, m in enumerate(lst):
+            if idx:
+                parts.append(', ')
+            if isinstance(m, Partitions):
+                compiler.write(m, parts, params)
+            else:
+                parts.append(m.table_name)
+
+    def jn2key(lst, params):
+        prefix, main, join, expr = lst
 
-    def tg2sql(lst):
-        args = map(sql, [m.table_name for m in lst])
-        return sql.join(', ', args)
+        if expr is None:
+            foreignkey = _detect_bridge(main, join)
+            expr = foreignkey == foreignkey.reference
+        return (prefix, join.table_name, compiler.key(expr, params))
 
-    def fm2sql(lst):
-        args = map(sql, [m.table_name for m in lst])
-        return sql.join(', ', args)
+    def od2key(lst, params):
+        node, desc = lst
+        return (compiler.key(node, params), desc)
+
+    def nodes2key(lst, params):  # group by, having, where, select
+        return tuple([compiler.key(node, params) for node in lst])
+
+    def lm2key(lst, params):
+        return lst
+
+    def pairs2key(lst, params):  # update set, insert values
+        return tuple([(expr.left.name, compiler.key(expr.right, params))
+                      for expr in lst])
+
+    def tables2key(lst, params):
+        return tuple([compiler.key(m, params) if isinstance(m, Partitions)
+                      else m.table_name for m in lst])
+
+    def rw2key(lst, params):
+        return tuple([tuple([compiler.key(val, params) for val in row])
+                      for row in lst])
+
+    rt_key_conversions = {
+        RT_OD: od2key,
+        RT_GP: nodes2key,
+        RT_HV: nodes2key,
+        RT_WH: nodes2key,
+        RT_SL: nodes2key,
+        RT_LM: lm2key,
+        RT_ST: pairs2key,
+        RT_VL: pairs2key,
+        RT_JN: jn2key,
+        RT_TG: tables2key,
+        RT_FM: tables2key,
+        RT_RW: rw2key,
+    }
 
     rt_conversions = {
         RT_OD: od2sql,
@@ -805,37 +2900,84 @@ class Compiler(object):
         RT_ST: st2sql,
         RT_VL: vl2sql,
         RT_JN: jn2sql,
-        RT_TG: tg2sql,
-        RT_FM: fm2sql,
+        RT_TG: tables2sql,
+        RT_FM: tables2sql,
+        RT_RW: rw2sql,
     }
 
     patterns = {
-        QUERY_INSERT: ('insert into %s %s', (RT_TG, RT_VL)),
+        QUERY_INSERT: ('insert into %s %s%s', (RT_TG, RT_VL, RT_RW)),
         QUERY_UPDATE: ('update %s set %s %s', (RT_TG, RT_ST, RT_WH)),
         QUERY_SELECT: ('select %s from %s %s %s %s %s %s %s', (
             RT_SL, RT_FM, RT_JN, RT_WH, RT_GP, RT_HV, RT_OD, RT_LM)),
         QUERY_DELETE: ('delete %s from %s %s', (RT_TG, RT_FM, RT_WH))
     }
 
-    def compile(self, type, runtime):
-        pattern = self.patterns[type]
+    # max number of compiled literals cached by query shape, 0 to disable
+    cache_size = 1000
+
+    def __init__(self):
+        self.cache = {}  # query shape => compiled literal
+        self.local = threading.local()  # dbapi compiled for, if not global
+        # literal pieces around the runtimes of each pattern
+        self.pieces = dict((type, spec.split('%s'))
+                           for type, (spec, rts) in self.patterns.items())
+
+    def compile(self, type, runtime, dbapi=None):
+        # for the connector `dbapi`, default to the one of `database`
+        outer, self.local.dbapi = getattr(self.local, 'dbapi', None), dbapi
+        try:
+            return self.compile_cached(type, runtime)
+        finally:
+            self.local.dbapi = outer
+
+    def compile_cached(self, type, runtime):
+        # only params differ between queries of the same shape, so reuse the
+        # literal compiled before and bind the new params.
+        if not self.cache_size:
+            return self.compile_runtime(type, runtime)
+
+        params = []
 
-        spec, rts = pattern
+        try:
+            key = [type, self.placeholder]
+            for tp in self.patterns[type][1]:
+                data = runtime.data[tp]
+                if data:
+                    key.append(self.rt_key_conversions[tp](data, params))
+                else:
+                    key.append(None)
+            key = tuple(key)
+            literal = self.cache.get(key)
+        except TypeError:  # unhashable, e.g. a list in limit
+            return self.compile_runtime(type, runtime)
+
+        if literal is not None:
+            return sql(literal, *params)
+
+        sq = self.compile_runtime(type, runtime)
+
+        if len(sq.params) == len(params):
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[key] = sq.literal
+        return sq
 
-        args = []
+    def compile_runtime(self, type, runtime):
+        pieces = self.pieces[type]
+        rts = self.patterns[type][1]
+        parts, params = [pieces[0]], []
 
-        for tp in rts:
+        for idx, tp in enumerate(rts):
             data = runtime.data[tp]
             if data:
-                args.append(self.rt_conversions[tp](data))
-            else:
-                args.append(sql(''))
+                self.rt_conversions[tp](data, parts, params)
+            parts.append(pieces[idx + 1])
 
-        sq = sql.format(spec, *args)
+        sq = sql(''.join(parts), *params)
         sq.normalize()
         return sq
 
-
 compiler = Compiler()
 
 
@@ -853,18 +2995,23 @@ class Runtime(object):
         RT_JN,  # join (inner, left, inner)
         RT_TG,  # target table
         RT_FM,  # from table
+        RT_RW,  # more rows to insert
     )
 
-    def __init__(self, model):
-        self.model = model
-        self.reset_data()
+    # runtimes are immutable, a setter returns a new runtime sharing the
+    # unchanged clauses with the old one.
 
-    def reset_data(self):
-        self.data = dict((k, []) for k in self.RUNTIMES)
+    def __init__(self, model, data=None):
+        self.model = model
+        if data is None:
+            data = dict((k, ()) for k in self.RUNTIMES)
+        self.data = data
 
     def _e(tp):
         def e(self, lst):
-            self.data[tp] = list(lst)
+            data = self.data.copy()
+            data[tp] = tuple(lst)
+            return Runtime(self.model, data)
         return e
 
     set_st = _e(RT_ST)
@@ -889,6 +3036,123 @@ class Runtime(object):
 
     set_fm = _e(RT_FM)
 
+    set_rw = _e(RT_RW)
+
+
+class Builder(object):
+    # an immutable query being built, can be kept and extended:
+    #
+    #   active = User.where(User.active == 1).orderby(User.id)
+    #   active.where(User.name == 'jack').select()
+    #   active.limit(10).select()
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    @property
+    def model(self):
+        return self.runtime.model
+
+    def __models(self):
+        if self.model.single:
+            return [self.model]
+        return self.model.models
+
+    def __kwargs(func):
+        def _func(self, *lst, **dct):
+            lst = list(lst)
+            if dct:
+                lst.extend([self.model.fields[k] == v for k, v in dct.items()])
+            return func(self, *lst)
+        return _func
+
+    @__kwargs
+    def update(self, *lst):
+        runtime = self.runtime.set_st(lst).set_tg(self.__models())
+        return UpdateQuery(runtime)
+
+    def select(self, *lst):
+        if not lst:
+            lst = sum([list(m.fields.values()) for m in self.__models()], [])
+        runtime = self.runtime.set_sl(lst).set_fm(self.__models())
+        return SelectQuery(runtime)
+
+    def delete(self, *targets):  # default target: all (mysql only)
+        runtime = self.runtime.set_fm(self.__models())
+        if not self.model.single:
+            runtime = runtime.set_tg(targets or self.__models())
+        return DeleteQuery(runtime)
+
+    @__kwargs
+    def where(self, *lst):  # conditions are joined with 'and'
+        return Builder(self.runtime.set_wh(self.runtime.data[RT_WH] + lst))
+
+    def at(self, id):
+        return self.where(self.model.primarykey == id)
+
+    def orderby(self, field, desc=False):
+        return Builder(self.runtime.set_od((field, desc)))
+
+    def groupby(self, *lst):
+        return Builder(self.runtime.set_gp(lst))
+
+    def having(self, *lst):  # conditions are joined with 'and'
+        return Builder(self.runtime.set_hv(self.runtime.data[RT_HV] + lst))
+
+    def limit(self, rows, offset=None):
+        return Builder(self.runtime.set_lm((offset, rows)))
+
+    def join(self, model, on=None, prefix=None):
+        return Builder(self.runtime.set_jn((prefix, self.model, model, on)))
+
+    def left_join(self, model, on=None):
+        return self.join(model, on=on, prefix='left')
+
+    def right_join(self, model, on=None):
+        return self.join(model, on=on, prefix='right')
+
+    def full_join(self, model, on=None):
+        return self.join(model, on=on, prefix='full')
+
+    def findone(self, *lst, **dct):
+        query = self.where(*lst, **dct).select()
+        result = query.execute()
+        return result.one()
+
+    def findall(self, *lst, **dct):
+        query = self.where(*lst, **dct).select()
+        result = query.execute()
+        return result.all()
+
+    def getone(self):
+        return self.select().execute().one()
+
+    def getall(self):
+        return self.select().execute().all()
+
+    def aggregator(name):
+        def _func(self, arg=None):
+            if arg is None:
+                arg = self.model.primarykey
+            function = Function(name, arg)
+            query = self.select(function)
+            if name == 'avg' and len(query.databases) > 1:  # over shards
+                count = self.count(arg)
+                return self.sum(arg) / float(count) if count else None
+            result = query.execute()
+            return result.tuples()[0][0]
+        return _func
+
+    count = aggregator('count')
+
+    sum = aggregator('sum')
+
+    max = aggregator('max')
+
+    min = aggregator('min')
+
+    avg = aggregator('avg')
+
 
 class MetaModel(type):
 
@@ -946,12 +3210,29 @@ class Model(MetaModel('NewBase', (dict, ), {})):  # py3 compat
     def __init__(self, *lst, **dct):
         for expr in lst:
             field, val = expr.left, expr.right
-            self[field.name] = val
+            dict.__setitem__(self, field.name, val)
 
         super(Model, self).update(dct)
-        self._cache = self.copy()
+        self._dirty = set()  # names of fields changed since last sync
         self.set_in_db(False)
 
+    def __setitem__(self, key, val):
+        try:
+            dirty = self._dirty
+        except AttributeError:  # unpickling, items come before __dict__
+            dirty = self._dirty = set()
+
+        if key not in dirty:
+            dirty.add(key)
+            if key in self:  # the value in db, to find the row by
+                self.__dict__.setdefault('_synced', {})[key] = \
+                    dict.__getitem__(self, key)
+        dict.__setitem__(self, key, val)
+
+    def sync(self):  # in sync with db
+        self._dirty.clear()
+        self.__dict__.pop('_synced', None)
+
     def set_in_db(self, boolean):
         self._in_db = boolean
 
@@ -964,30 +3245,112 @@ class Model(MetaModel('NewBase', (dict, ), {})):  # py3 compat
             return func(cls, *lst)
         return _func
 
+    def __builder(name):  # start building a query on this model
+        @classmethod
+        def _func(cls, *args, **kwargs):
+            return getattr(Builder(cls.runtime), name)(*args, **kwargs)
+        return _func
+
     @__kwargs
     def insert(cls, *lst, **dct):
-        cls.runtime.set_vl(lst)
-        cls.runtime.set_tg([cls])
-        return InsertQuery(cls.runtime)
+        runtime = cls.runtime.set_vl(lst).set_tg([cls])
+        return InsertQuery(runtime)
 
-    @__kwargs
-    def update(cls, *lst, **dct):
-        cls.runtime.set_st(lst)
-        cls.runtime.set_tg([cls])
-        return UpdateQuery(cls.runtime)
+    @classmethod
+    def insert_many(cls, rows, batch_size=1000):
+        # insert rows (dicts or instances) with multi-rows inserts, returns
+        # ids of inserted rows, or None if they are unknown.
+        sharding = getattr(cls, 'sharding', None)
+        partitioning = getattr(cls, 'partitioning', None)
+        if sharding is None and partitioning is None:
+            return cls.__insert_batches(rows, batch_size)
+
+        # rows of each shard and partition apart, ids in the order of rows
+        groups = {}  # (database, partition) => (indexes, rows)
+        for idx, row in enumerate(rows):
+            key = [None, None]
+            if sharding is not None:
+                name = sharding.field(cls).name
+                if name not in row:
+                    raise ShardKeyNotFound
+                key[0] = sharding.locate(row[name])
+            if partitioning is not None:
+                name = partitioning.field(cls).name
+                if name not in row:
+                    raise PartitionKeyNotFound
+                key[1] = partitioning.suffix(row[name])
+            group = groups.setdefault(tuple(key), ([], []))
+            group[0].append(idx)
+            group[1].append(row)
+
+        ids = {}
+        for indexes, group in groups.values():
+            group_ids = cls.__insert_batches(group, batch_size)
+            if group_ids is None:
+                return None
+            ids.update(zip(indexes, group_ids))
+        return [ids[idx] for idx in sorted(ids)]
 
     @classmethod
-    def select(cls, *lst):
-        if not lst:
-            lst = cls.fields.values()
-        cls.runtime.set_sl(lst)
-        cls.runtime.set_fm([cls])
-        return SelectQuery(cls.runtime)
+    def __insert_batches(cls, rows, batch_size):
+        ids = []
+
+        for batch in cls.__batches(rows, batch_size):
+            names = list(batch[0].keys())
+            fields = [cls.fields[name] for name in names]
+            runtime = cls.runtime.set_tg([cls]).set_vl(
+                [field == batch[0][field.name] for field in fields]).set_rw(
+                [tuple([row[name] for name in names]) for row in batch[1:]])
+
+            query = InsertQuery(runtime)
+
+            if query.rows > 1:
+                batch_ids = query.execute()
+            else:  # single row insert returns an id
+                batch_ids = [query.execute()]
+
+            if ids is not None and batch_ids is not None:
+                ids.extend(batch_ids)
+            else:
+                ids = None
+        return ids
 
     @classmethod
-    def delete(cls):
-        cls.runtime.set_fm([cls])
-        return DeleteQuery(cls.runtime)
+    def __batches(cls, rows, batch_size):
+        # split rows into batches of the same columns, within the limits of
+        # batch size, number of params and bytes of a statement
+        sharding = getattr(cls, 'sharding', None)
+        dbapi = database.dbapi if sharding is None else sharding.dbapi()
+        batch, keys, params, size = [], None, 0, 0
+
+        for row in rows:
+            row_keys = set(row.keys())
+            row_size = 0
+            if dbapi.max_packet is not None:
+                row_size = sum(map(dbapi.sizeof, row.values()))
+
+            if batch and (
+                    row_keys != keys or len(batch) >= batch_size or
+                    dbapi.max_params is not None and
+                    params + len(row) > dbapi.max_params or
+                    dbapi.max_packet is not None and
+                    size + row_size > dbapi.max_packet):
+                yield batch
+                batch, params, size = [], 0, 0
+
+            batch.append(row)
+            keys = row_keys
+            params += len(row)
+            size += row_size
+
+        if batch:
+            yield batch
+
+    update = __builder('update')
+
+    select = __builder('select')
+
+    delete = __builder('delete')
 
     @classmethod
     def create(cls, *lst, **dct):
@@ -1001,71 +3364,33 @@ class Model(MetaModel('NewBase', (dict, ), {})):  # py3 compat
             return inst
         return None
 
-    @__kwargs
-    def where(cls, *lst, **dct):
-        cls.runtime.set_wh(lst)
-        return cls
+    where = __builder('where')
 
-    @classmethod
-    def at(cls, id):
-        return cls.where(cls.primarykey == id)
+    at = __builder('at')
 
-    @classmethod
-    def orderby(cls, field, desc=False):
-        cls.runtime.set_od((field, desc))
-        return cls
+    orderby = __builder('orderby')
 
-    @classmethod
-    def groupby(cls, *lst):
-        cls.runtime.set_gp(lst)
-        return cls
+    groupby = __builder('groupby')
 
-    @classmethod
-    def having(cls, *lst):
-        cls.runtime.set_hv(lst)
-        return cls
+    having = __builder('having')
 
-    @classmethod
-    def limit(cls, rows, offset=None):
-        cls.runtime.set_lm((offset, rows))
-        return cls
+    limit = __builder('limit')
 
-    @classmethod
-    def join(cls, model, on=None, prefix=None):
-        cls.runtime.set_jn((prefix, cls, model, on))
-        return cls
+    join = __builder('join')
 
-    @classmethod
-    def left_join(cls, model, on=None):
-        return cls.join(model, on=on, prefix='left')
+    left_join = __builder('left_join')
 
-    @classmethod
-    def right_join(cls, model, on=None):
-        return cls.join(model, on=on, prefix='right')
+    right_join = __builder('right_join')
 
-    @classmethod
-    def full_join(cls, model, on=None):
-        return cls.join(model, on=on, prefix='full')
+    full_join = __builder('full_join')
 
-    @classmethod
-    def findone(cls, *lst, **dct):
-        query = cls.where(*lst, **dct).select()
-        result = query.execute()
-        return result.one()
+    findone = __builder('findone')
 
-    @classmethod
-    def findall(cls, *lst, **dct):
-        query = cls.where(*lst, **dct).select()
-        result = query.execute()
-        return result.all()
+    findall = __builder('findall')
 
-    @classmethod
-    def getone(cls):
-        return cls.select().execute().one()
+    getone = __builder('getone')
 
-    @classmethod
-    def getall(cls):
-        return cls.select().execute().all()
+    getall = __builder('getall')
 
     @property
     def _id(self):
@@ -1078,118 +3403,67 @@ class Model(MetaModel('NewBase', (dict, ), {})):  # py3 compat
             id = model.insert(**self).execute()
 
             if id is not None:
-                self[model.primarykey.name] = id
+                dict.__setitem__(self, model.primarykey.name, id)
                 self.set_in_db(True)
-                self._cache = self.copy()  # sync cache on saving
+                self.sync()
             return id
         else:  # update
-            dct = dict(set(self.items()) - set(self._cache.items()))
+            dct = dict((k, self[k]) for k in self._dirty if k in self)
 
             if self._id is None:
                 raise PrimaryKeyValueNotFound
 
             if dct:
-                query = model.at(self._id).update(**dct)
+                query = self.__at().update(**dct)
                 rows_affected = query.execute()
             else:
                 rows_affected = 0
-            self._cache = self.copy()
+            self.sync()
             return rows_affected
 
+    def __at(self):  # builder at this row, on its shard and partition
+        model = type(self)
+        builder = model.at(self._id)
+        synced = self.__dict__.get('_synced') or {}
+
+        for strategy in (getattr(model, 'sharding', None),
+                         getattr(model, 'partitioning', None)):
+            if strategy is not None:
+                field = strategy.field(model)
+                if field is not model.primarykey and field.name in self:
+                    # where the row is, even if the key was changed since
+                    value = synced.get(field.name, self[field.name])
+                    builder = builder.where(field == value)
+        return builder
+
     def destroy(self):
         if self._in_db:
             if self._id is None:
                 raise PrimaryKeyValueNotFound
-            result = type(self).at(self._id).delete().execute()
+            result = self.__at().delete().execute()
             if result:
                 self.set_in_db(False)
             return result
         return None
 
-    def aggregator(name):
-        @classmethod
-        def _func(cls, arg=None):
-            if arg is None:
-                arg = cls.primarykey
-            function = Function(name, arg)
-            query = cls.select(function)
-            result = query.execute()
-            return result.tuples()[0][0]
-        return _func
-
-    count = aggregator('count')
+    count = __builder('count')
 
-    sum = aggregator('sum')
+    sum = __builder('sum')
 
-    max = aggregator('max')
+    max = __builder('max')
 
-    min = aggregator('min')
+    min = __builder('min')
 
-    avg = aggregator('avg')
+    avg = __builder('avg')
 
 
-class MultiModels(object):
+class MultiModels(Builder):
 
     single = False
 
     def __init__(self, *models):
         self.models = models
-        self.runtime = Runtime(self)
-
-    def select(self, *lst):
-        if not lst:
-            lst = sum([list(m.fields.values()) for m in self.models], [])
-        self.runtime.set_sl(lst)
-        self.runtime.set_fm(self.models)
-        return SelectQuery(self.runtime)
-
-    def delete(self, *targets):  # default target: all (mysql only)
-        if not targets:
-            targets = self.models
-        self.runtime.set_fm(self.models)
-        self.runtime.set_tg(targets)
-        return DeleteQuery(self.runtime)
-
-    def update(self, *lst):
-        self.runtime.set_fm(self.models)
-        self.runtime.set_set(lst, {})
-        return UpdateQuery(self.runtime)
-
-    def where(self, *lst):
-        self.runtime.set_wh(lst)
-        return self
-
-    def orderby(self, field, desc=False):
-        self.runtime.set_od((field, desc))
-        return self
-
-    def groupby(self, *lst):
-        self.runtime.set_gp(lst)
-        return self
-
-    def having(self, *lst):
-        self.runtime.set_hv(lst)
-        return self
-
-    def limit(self, rows, offset=None):
-        self.runtime.set_lm((offset, rows))
-        return self
-
-    def findone(self, *lst):
-        query = self.where(*lst).select()
-        result = query.execute()
-        return result.one()
-
-    def findall(self, *lst):
-        query = self.where(*lst).select()
-        result = query.execute()
-        return result.all()
-
-    def getone(self):
-        return self.select().execute().one()
-
-    def getall(self):
-        return self.select().execute().all()
+        super(MultiModels, self).__init__(Runtime(self))
 
 
 Models = MultiModels
@@ -1200,25 +3474,8 @@ class JoinModel(MultiModels):
     def __init__(self, main, join):
         super(JoinModel, self).__init__(main, join)
         self.bridge = _detect_bridge(main, join)
-
-    def build_bridge(func):
-        def _func(self, *args, **kwargs):
-            self.runtime.data[RT_WH].append(
-                self.bridge == self.bridge.reference)
-            return func(self, *args, **kwargs)
-        return _func
-
-    @build_bridge
-    def select(self, *lst):
-        return super(JoinModel, self).select(*lst)
-
-    @build_bridge
-    def update(self, *lst):
-        return super(JoinModel, self).update(*lst)
-
-    @build_bridge
-    def delete(self, *targets):
-        return super(JoinModel, self).delete(*targets)
+        self.runtime = self.runtime.set_wh([
+            self.bridge == self.bridge.reference])
 
 
 def _detect_bridge(m, n):
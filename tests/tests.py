@@ -2,7 +2,12 @@
 
 import os
 import sys
+import pickle
+import time
 import logging
+import threading
+from array import array
+from datetime import date
 logging.basicConfig(level=logging.INFO)
 from decimal import Decimal
 
@@ -10,7 +15,11 @@ import toml
 
 sys.path.insert(0, '..')
 from skylark import Database, database, DBAPI_MAPPINGS, DatabaseType,\
-    Model, fn, sql, distinct, PrimaryKeyValueNotFound, compiler, Models
+    Model, fn, sql, distinct, PrimaryKeyValueNotFound, compiler, Models, \
+    ConnectionPool, PoolTimeout, SQLSyntaxError, Columns, Sharding, \
+    ShardKeyNotFound, Field, PrimaryKey, ForeignKey, HashPartitioning, \
+    MonthPartitioning, PartitionKeyNotFound, PartitionNotFound, \
+    TransactionAborted, WriteJob, SkylarkException
 
 from models import User, Post
 
@@ -83,6 +92,8 @@ class TestDatabase_:
     def test_init(self):
         assert self.database.conn is None
         assert self.database.configs == {}
+        self.database.config(db='mydb')
+        assert self.database._dbapi is None  # connector resolved on use
         assert self.database.dbapi.module.__name__ in DBAPI_MAPPINGS
 
         # test load orders
@@ -98,11 +109,296 @@ class TestDatabase_:
             self.__shouldnt_import('MySQLdb')
             self.__shouldnt_import('pymysql')
 
+    def test_sqlite_profile(self):
+        path = 'skylarktests_profile'
+        api = DBAPI_MAPPINGS['sqlite3'](__import__('sqlite3'))
+        conn = api.connect(dict(db=path, profile='read', cached_statements=8,
+                                pragmas={'cache_size': -1000}))
+        try:
+            pragma = lambda name: conn.execute('pragma ' + name).fetchone()[0]
+            assert pragma('journal_mode') == 'wal'
+            assert pragma('synchronous') == 1  # normal
+            assert pragma('cache_size') == -1000
+            assert pragma('temp_store') == 2  # memory
+        finally:
+            conn.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
     def test_set_dbapi(self):
         self.database.set_dbapi(dbapi)
         assert self.database.dbapi.module.__name__ == dbapi_name
 
 
+class TestReplica(Test):
+
+    def setUp(self):
+        super(TestReplica, self).setUp()
+        database.config(sticky_window=0.2, **configs)
+        self.replica = database.add_replica('r1')  # same server here
+        database.sticky.set(0)
+
+    def tearDown(self):
+        database.remove_replica('r1')
+        database.config(**configs)
+        super(TestReplica, self).tearDown()
+
+    def test_route(self):
+        assert database.route(True) is self.replica
+        assert database.route(False) is database
+        # read your writes
+        assert database.route(True) is database
+        time.sleep(0.2)
+        assert database.route(True) is self.replica
+
+        with database.transaction():
+            assert database.route(True) is database
+        assert database.route(True) is database  # committed a write
+        time.sleep(0.2)
+
+        database.remove_replica('r1')
+        assert database.route(True) is database
+
+    def test_queries(self):
+        assert User.create(name='jack')
+        assert database.sticky.get() > 0
+        time.sleep(0.2)
+        assert User.getone().name == 'jack'
+        assert self.replica.pool.count == 1  # read on replica
+        assert [user.name for user in User.select().iterator()] == ['jack']
+        # sticky scope is per thread
+        assert User.at(1).update(name='tom').execute() == 1
+        routes = []
+        thread = threading.Thread(
+            target=lambda: routes.append(database.route(True)))
+        thread.start()
+        thread.join()
+        assert routes == [self.replica]
+        assert database.route(True) is database
+
+
+class TestTenant(Test):
+
+    def test_tenant(self):
+        name = configs['db']  # the same schema here
+        assert User.create(name='jack')
+
+        with database.tenant(name) as db:
+            assert db is database.get_tenant(name)
+            assert db.configs['db'] == name
+            assert database.route(True) is db
+            assert User.getone().name == 'jack'
+            assert db.pool.count == 1
+
+            with database.transaction():
+                assert db.in_transaction()
+                User.create(name='tom')
+            assert not db.in_transaction()
+
+            # other threads are not affected
+            routes = []
+            thread = threading.Thread(
+                target=lambda: routes.append(database.route(True)))
+            thread.start()
+            thread.join()
+            assert routes == [database]
+
+        assert database.route(True) is database
+        assert User.count() == 2
+        assert database.tenants == {name: db}
+        database.config(**configs)
+        assert database.tenants == {}
+
+    def test_gather(self):
+        with database.tenant(configs['db']):
+            with database.transaction():  # on its connection
+                User.create(name='jack')
+                results = database.gather(User.count, User.count)
+        assert results == [1, 1]
+
+    def test_release(self):
+        with database.tenant(configs['db']) as db:
+            database.begin()
+            User.create(name='jack')
+            database.release()  # rolls back the tenant's transaction
+            assert not db.in_transaction() and db.conn is None
+        assert User.count() == 0
+
+    def test_lost_write(self):
+        execute_cursor = database.dbapi.execute_cursor
+
+        def execute_lost(cursor, args):  # lost after the statement ran
+            execute_cursor(cursor, args)
+            raise dbapi.OperationalError('lost')
+
+        database.dbapi.execute_cursor = execute_lost
+        database.dbapi.is_disconnect = lambda exc: True
+        try:
+            with database.tenant(configs['db']):
+                try:
+                    User.create(name='jack')
+                except dbapi.OperationalError:
+                    pass
+                else:
+                    raise Exception
+        finally:
+            del database.dbapi.execute_cursor
+            del database.dbapi.is_disconnect
+        assert User.count() == 1  # not executed again
+
+
+class TestWriter(Test):
+
+    def setUp(self):
+        super(TestWriter, self).setUp()
+        database.config(writer=True, writer_batch=4, **configs)
+
+    def tearDown(self):
+        database.config(**configs)
+        super(TestWriter, self).tearDown()
+
+    def test_writer(self):
+        def create(base):
+            for i in range(base, base + 5):
+                User.create(id=i, name='name%d' % i)
+
+        threads = [threading.Thread(target=create, args=(base, ))
+                   for base in (1, 6, 11, 16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert User.count() == 20
+        assert database.writer is not None
+
+        try:
+            User.create(id=1, name='jack')
+        except dbapi.IntegrityError:
+            pass
+        else:
+            raise Exception
+        assert User.at(2).update(name='jack').execute() == 1
+        assert User.findone(name='jack').id == 2
+
+        with database.transaction():  # on a pooled connection
+            User.create(id=21, name='tom')
+        assert User.count() == 21
+
+        writer = database.writer
+        database.close()
+        assert database.writer is None and not writer.thread.is_alive()
+
+    def test_batch(self):
+        writer = database.get_writer()
+        sqls = [User.insert(id=id, name='name%d' % id).sql
+                for id in (1, 2, 1, 3)]
+        jobs = [WriteJob((sql.literal, sql.params)) for sql in sqls]
+
+        started, resume = threading.Event(), threading.Event()
+        execute_cursor = database.dbapi.execute_cursor
+
+        def execute_blocked(cursor, args):
+            started.set()
+            resume.wait()
+            return execute_cursor(cursor, args)
+
+        database.dbapi.execute_cursor = execute_blocked
+        writer.queue.put(jobs[0])
+        started.wait()
+        del database.dbapi.execute_cursor
+        # queued meanwhile, applied in one batch, each in a savepoint
+        for job in jobs[1:]:
+            writer.queue.put(job)
+        resume.set()
+        for job in jobs:
+            job.done.wait()
+
+        assert isinstance(jobs[2].error, dbapi.IntegrityError)
+        assert [job.error for job in jobs[:2] + jobs[3:]] == [None] * 3
+        assert User.count() == 3
+
+
+class TestReplicaBalance(Test):
+
+    def setUp(self):
+        super(TestReplicaBalance, self).setUp()
+        database.config(probe_interval=None, **configs)
+        self.r1 = database.add_replica('r1')
+        self.r2 = database.add_replica('r2')
+        database.sticky.set(0)
+
+    def tearDown(self):
+        database.remove_replica('r1')
+        database.remove_replica('r2')
+        database.config(**configs)
+        super(TestReplicaBalance, self).tearDown()
+
+    def test_latency(self):
+        self.r1.record(0.5)
+        self.r2.record(0.1)
+        assert database.route(True) is self.r2
+        for i in range(10):
+            self.r2.record(1)
+        assert database.route(True) is self.r1
+        assert 0.1 < self.r2.latency < 1
+        # latency of queries
+        User.getone()
+        assert self.r1.latency < 0.1
+
+    def test_eject(self):
+        for i in range(3):
+            self.r1.record(None)
+        assert self.r1.healthy
+        self.r1.record(None)
+        assert not self.r1.healthy
+        assert database.choose_replica() is self.r2
+        for i in range(4):
+            self.r2.record(None)
+        assert database.route(True) is database  # all ejected
+        # probes bring them back
+        self.r1.probe()
+        assert self.r1.healthy and database.route(True) is self.r1
+
+    def test_failover(self):
+        self.r1.record(0.5)
+        self.r2.record(0.1)
+        def execute_down(args, retry=False):
+            self.r2.record(None)
+            raise dbapi.OperationalError('down')
+
+        self.r2.execute_args = execute_down
+        database.dbapi.is_unavailable = lambda exc: True
+        try:
+            # still healthy, yet the read is not retried on it
+            assert User.getone() is None
+            assert self.r2.healthy and self.r1.pool.count == 1
+            database.remove_replica('r1')
+            assert User.getone() is None  # on the primary
+        finally:
+            del self.r2.execute_args
+            del database.dbapi.is_unavailable
+
+    def test_probe(self):
+        self.r1.probe()
+        assert self.r1.pool.count == 1 and self.r1.latency > 0
+        # skipped while all connections are in use
+        self.r1.pool.size = 1
+        conn = self.r1.pool.acquire()
+        self.r1.probe()
+        self.r1.pool.release(conn)
+        assert self.r1.error_rate == 0
+
+        # in background
+        db = DatabaseType()
+        db.set_dbapi(dbapi)
+        db.config(probe_interval=0.05, **configs)
+        replica = db.add_replica('r')
+        time.sleep(0.2)
+        assert replica.latency > 0
+        db.remove_replica('r')
+
+
 class TestDatabase(Test):
 
     def setUp(self):
@@ -129,6 +425,83 @@ class TestDatabase(Test):
         assert self.database.dbapi.conn_is_open(conn1)
         assert self.database.dbapi.conn_is_open(conn2)
 
+    def test_cursor(self):
+        # rows are read before the connection goes back to the pool
+        self.database.config(**configs)
+        self.database.execute("insert into t_user(name) values ('jack')")
+        self.database.execute("insert into t_user(name) values ('tom')")
+        cursor = self.database.execute('select name from t_user')
+        conn = self.database.pool.acquire()  # its next user
+        self.database.dbapi.set_autocommit(conn, False)
+        self.database.dbapi.execute_cursor(conn.cursor(), (
+            "insert into t_user(name) values ('amy')", ()))
+        self.database.dbapi.rollback_transaction(conn)
+        self.database.dbapi.set_autocommit(conn, True)
+        self.database.pool.release(conn)
+        assert cursor.fetchone() == ('jack', )
+        assert list(cursor) == [('tom', )]
+        assert cursor.fetchall() == [] and cursor.fetchone() is None
+
+    def test_dead_conn(self):
+        # a bound connection failing its ping is dropped, not reused
+        self.database.config(pool_ping_interval=0.01, **configs)
+        self.database.set_autocommit(False)
+        conn = self.database.get_conn()
+        time.sleep(0.02)
+        self.database.dbapi.conn_is_alive = lambda conn: False
+        try:
+            assert self.database.get_conn() is not conn
+        finally:
+            del self.database.dbapi.conn_is_alive
+            self.database.set_autocommit(True)
+        assert not self.database.dbapi.conn_is_open(conn)
+        assert self.database.pool.count == 1
+
+    def test_fork(self):
+        if not hasattr(os, 'fork'):
+            return
+        self.database.config(**configs)
+        conn = self.database.get_conn()
+        pid = os.fork()
+        if pid == 0:  # child: a connection of its own, parent's untouched
+            try:
+                ok = self.database.get_conn() is not conn
+                self.database.close()
+                self.database.execute('select 1')
+            except Exception:
+                ok = False
+            os._exit(0 if ok else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+        assert self.database.get_conn() is conn
+        assert self.database.execute('select 1').fetchall() == [(1, )]
+
+    def test_conn_per_statement(self):
+        # out of transactions, threads hold a connection per statement only
+        self.database.config(pool_size=2, **configs)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.database.execute('select 1').fetchall()))
+            for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 6
+        assert self.database.pool.count <= 2
+
+        # idle connections take the new autocommit mode
+        self.database.set_autocommit(False)
+        try:
+            with self.database.transaction():
+                self.database.execute(
+                    "insert into t_user (name, email) values ('a', 'a')")
+                raise ValueError
+        except ValueError:
+            pass
+        self.database.set_autocommit(True)
+        assert self.database.execute(
+            'select count(*) from t_user').fetchone()[0] == 0
+
     def test_get_conn(self):
         assert self.database.conn is None
         self.database.config(**configs)
@@ -195,6 +568,141 @@ class TestDatabase(Test):
         assert cursor.fetchone()[0] == 3
 
 
+class TestConnectionPool:
+
+    def setUp(self):
+        self.dbapi = database.dbapi
+        self.pool = ConnectionPool(self.dbapi, configs, size=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_acquire_release(self):
+        conn = self.pool.acquire()
+        assert self.dbapi.conn_is_open(conn)
+        assert self.pool.count == 1
+        self.pool.release(conn)
+        assert self.pool.acquire() is conn
+        assert self.pool.count == 1
+
+    def test_size(self):
+        self.pool.timeout = 0.05
+        conn1 = self.pool.acquire()
+        conn2 = self.pool.acquire()
+        assert conn1 is not conn2
+        try:
+            self.pool.acquire()
+        except PoolTimeout:
+            pass
+        else:
+            raise Exception
+        self.pool.release(conn2)
+        assert self.pool.acquire() is conn2
+
+    def test_wait(self):
+        conn1 = self.pool.acquire()
+        conn2 = self.pool.acquire()
+        timer = threading.Timer(0.05, self.pool.release, (conn1,))
+        timer.start()
+        assert self.pool.acquire() is conn1
+        timer.join()
+
+    def test_min_size(self):
+        self.pool.min_size = 2
+        conn = self.pool.acquire()
+        assert self.pool.count == 2
+        assert len(self.pool.idle) == 1
+        self.pool.release(conn)
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0.01
+        conn1 = self.pool.acquire()
+        conn2 = self.pool.acquire()
+        self.pool.release(conn1)
+        time.sleep(0.02)
+        self.pool.release(conn2)  # conn1 was idle for too long
+        assert self.pool.idle == [conn2]
+        assert not self.dbapi.conn_is_open(conn1)
+
+    def test_max_lifetime(self):
+        self.pool.max_lifetime = 0.01
+        conn = self.pool.acquire()
+        time.sleep(0.02)
+        self.pool.release(conn)
+        assert not self.dbapi.conn_is_open(conn)
+        assert self.pool.count == 0
+
+    def test_close(self):
+        conn1 = self.pool.acquire()
+        conn2 = self.pool.acquire()
+        self.pool.release(conn1)
+        self.pool.close()
+        assert not self.dbapi.conn_is_open(conn1)
+        assert self.dbapi.conn_is_open(conn2)
+        self.pool.release(conn2)
+        assert not self.dbapi.conn_is_open(conn2)
+
+    def test_ping_interval(self):
+        pings = []
+        self.dbapi.conn_is_alive = lambda conn: pings.append(conn) or True
+        try:
+            self.pool.ping_interval = 0.01
+            conn = self.pool.acquire()
+            self.pool.release(conn)
+            assert self.pool.acquire() is conn
+            assert pings == []  # used recently
+            self.pool.release(conn)
+            time.sleep(0.02)
+            assert self.pool.acquire() is conn
+            assert pings == [conn]
+        finally:
+            del self.dbapi.conn_is_alive
+
+    def test_dead_conn(self):
+        pings = []
+        self.pool.ping_interval = 0.01
+        conn1 = self.pool.acquire()
+        conn2 = self.pool.acquire()
+        self.pool.release(conn1)
+        time.sleep(0.02)
+
+        def ping(conn):  # out of the lock, others don't wait
+            thread = threading.Thread(target=self.pool.release, args=(conn2, ))
+            thread.start()
+            thread.join(1)
+            pings.append(thread.is_alive())
+            return False
+
+        self.dbapi.conn_is_alive = ping
+        try:
+            assert self.pool.acquire() is conn2
+        finally:
+            del self.dbapi.conn_is_alive
+        assert pings == [False]
+        assert not self.dbapi.conn_is_open(conn1) and self.pool.count == 1
+
+    def test_threads(self):
+        db = DatabaseType()
+        db.set_dbapi(dbapi)
+        db.config(pool_size=4, **configs)
+        conns = []
+
+        def run():
+            conns.append(db.get_conn())
+            time.sleep(0.05)
+            db.release()
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(map(id, conns))) == 4
+        assert len(db.pool.idle) == 4
+        assert db.get_conn() in conns
+        db.close()
+
+
 class TestField_:
 
     def test_name(self):
@@ -285,6 +793,14 @@ class TestAlias(Test):
 
 class TestModel_:
 
+    def test_pickle(self):
+        user = User(name='jack')
+        user.email = 'jack@gmail.com'
+        loaded = pickle.loads(pickle.dumps(user, 2))
+        assert loaded == user and type(loaded) is User
+        assert loaded._dirty == set(['email'])
+        assert not loaded._in_db
+
     def test_table_name(self):
         class MyModel(Model):
             pass
@@ -340,6 +856,342 @@ class TestModel_:
         assert field_names == _field_names
 
 
+class TestRuntime_:
+
+    def test_threads(self):
+        built = threading.Event()
+        compiled = threading.Event()
+        queries = []
+
+        def run():
+            builder = User.where(User.id == 1)
+            built.set()
+            compiled.wait()
+            queries.append(builder.select(User.id))
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        built.wait()
+        # the where clause built in another thread shouldn't leak here
+        query = User.where(User.id == 2).select(User.id)
+        compiled.set()
+        thread.join()
+        assert query.sql.params == (2,)
+        assert queries[0].sql.params == (1,)
+
+
+class TestBuilder_:
+
+    def eq(self, query, string, data):
+        string = string.replace('?', database.dbapi.placeholder)
+        return query.sql.literal == string and query.sql.params == data
+
+    def test_immutable(self):
+        builder = User.where(User.id > 1)
+        builder.orderby(User.id).limit(2)
+        assert self.eq(builder.select(User.id),
+                       'select t_user.id from t_user where t_user.id > ?',
+                       (1,))
+        assert self.eq(User.select(User.id), 'select t_user.id from t_user',
+                       ())
+
+    def test_reuse(self):
+        base = User.where(User.id > 1).orderby(User.id)
+        query1 = base.where(name='jack').select(User.id)
+        query2 = base.limit(2).select(User.id)
+        assert self.eq(query1, 'select t_user.id from t_user where '
+                       't_user.id > ? and t_user.name = ? order by t_user.id',
+                       (1, 'jack'))
+        assert self.eq(query2, 'select t_user.id from t_user where '
+                       't_user.id > ? order by t_user.id limit 2', (1,))
+        assert query1.sql.params == (1, 'jack')  # query1 kept
+
+
+shards = []
+
+for i in range(2):
+    name = 'skylarktests_shard%d' % i
+    if db_type == 'mysql':
+        database.execute('create database if not exists %s' % name)
+    shard = DatabaseType()
+    shard.set_dbapi(dbapi)
+    shard.config(**dict(configs, db=name))
+    shards.append(shard)
+
+
+class ShardedUser(Model):
+    table_name = 't_user'
+    name = Field()
+    email = Field()
+    sharding = Sharding(shards)
+
+
+class ShardedPost(Model):
+    table_name = 't_post'
+    post_id = PrimaryKey()
+    name = Field()
+    user_id = ForeignKey(ShardedUser.id)
+    sharding = Sharding(shards, key='user_id')
+
+
+class TestSharding:
+
+    def setUp(self):
+        for shard in shards:
+            shard.execute(user_sql)
+            shard.execute(post_sql)
+
+    def tearDown(self):
+        for shard in shards:
+            shard.execute('drop table t_post')
+            shard.execute('drop table t_user')
+            shard.close()
+
+    def create_data(self):
+        for i in range(1, 7):
+            ShardedUser.create(id=i, name='name%d' % (i % 3), email='e%d' % i)
+
+    def test_insert(self):
+        self.create_data()
+        assert shards[0].execute('select id from t_user').fetchall() == \
+            [(2, ), (4, ), (6, )]
+        try:
+            ShardedUser.create(name='jack')
+        except ShardKeyNotFound:
+            pass
+        else:
+            raise Exception
+        ids = ShardedUser.insert_many(
+            [dict(id=i, name='x') for i in (9, 8, 7, 10)], batch_size=2)
+        assert ids == [9, 8, 7, 10]
+        assert ShardedUser.count() == 10
+
+    def test_route(self):
+        self.create_data()
+        query = ShardedUser.at(3).select()
+        assert query.databases == [shards[1]]
+        assert query.execute().one().email == 'e3'
+        query = ShardedUser.where(ShardedUser.id._in(1, 3), name='name1')
+        assert query.select().databases == [shards[1]]
+        assert len(ShardedUser.where(name='name1').select().databases) == 2
+
+    def test_fan_out(self):
+        self.create_data()
+        query = ShardedUser.orderby(ShardedUser.id, desc=True).limit(
+            3, offset=1).select(ShardedUser.id)
+        assert query.execute().tuples() == ((5, ), (4, ), (3, ))
+        assert ShardedUser.count() == 6
+        assert ShardedUser.sum(ShardedUser.id) == 21
+        assert ShardedUser.max(ShardedUser.id) == 6
+        assert ShardedUser.min(ShardedUser.id) == 1
+        assert ShardedUser.avg(ShardedUser.id) == 3.5
+        query = ShardedUser.groupby(ShardedUser.name).orderby(
+            ShardedUser.name).select(
+                ShardedUser.name, fn.count(ShardedUser.id))
+        assert query.execute().tuples() == (
+            ('name0', 2), ('name1', 2), ('name2', 2))
+        ids = sorted(user.id for user in ShardedUser.select().iterator(size=2))
+        assert ids == [1, 2, 3, 4, 5, 6]
+        query = ShardedUser.orderby(ShardedUser.id, desc=True).limit(
+            3, offset=1).select(ShardedUser.id)
+        assert [u.id for u in query.iterator(size=2)] == [5, 4, 3]
+        assert list(query.columns(size=1)['id']) == [5, 4, 3]
+        query = ShardedUser.groupby(ShardedUser.name).select(
+            ShardedUser.name, fn.count(ShardedUser.id))
+        assert sorted(query.iterator(mode='tuples')) == [
+            ('name0', 2), ('name1', 2), ('name2', 2)]
+        assert ShardedUser.where(name='name1').update(email='x').execute() == 2
+        # rows of shards can't be ordered by a field not selected
+        try:
+            ShardedUser.orderby(ShardedUser.id).limit(2).select(
+                ShardedUser.name)
+        except SkylarkException:
+            pass
+        else:
+            raise Exception
+        query = ShardedUser.at(3).orderby(ShardedUser.id).select(
+            ShardedUser.name)
+        assert query.execute().tuples() == (('name0', ), )
+
+    def test_join(self):
+        self.create_data()
+        for i in range(1, 7):
+            ShardedPost.create(name='post%d' % i, user_id=i)
+        query = (ShardedUser & ShardedPost).where(ShardedUser.id == 3).select(
+            ShardedUser.name, ShardedPost.name)
+        assert query.databases == [shards[1]]
+        assert query.execute().tuples() == (('name0', 'post3'), )
+        query = ShardedUser.join(ShardedPost).select(ShardedPost.name)
+        assert len(query.databases) == 2
+        assert query.execute().count == 6
+
+    def test_placeholder(self):
+        # compiled for the connector of the shards, not of `database`
+        placeholder = database.dbapi.placeholder
+        database.dbapi.placeholder = '$'
+        try:
+            query = ShardedUser.at(3).select()
+            assert query.sql.literal.endswith(
+                't_user.id = %s' % shards[1].dbapi.placeholder)
+            assert query.execute().count == 0
+        finally:
+            database.dbapi.placeholder = placeholder
+
+    def test_fan_out_in_transaction(self):
+        self.create_data()
+        try:
+            with shards[0].transaction():  # its part runs in it
+                query = ShardedUser.where(name='name1').update(name='jack')
+                assert query.execute() == 2
+                raise ValueError
+        except ValueError:
+            pass
+        assert ShardedUser.at(4).getone().name == 'name1'
+        assert ShardedUser.at(1).getone().name == 'jack'
+
+    def test_fan_out_on_workers(self):
+        self.create_data()
+        workers, database.async_workers = database.async_workers, 2
+        executor, database.executor = database.executor, None
+        try:  # fan-outs within jobs don't wait for the busy workers
+            counts = database.gather(ShardedUser.count, ShardedUser.count)
+        finally:
+            if database.executor is not None:  # threads on py2
+                database.executor.shutdown()
+            database.executor, database.async_workers = executor, workers
+        assert counts == [6, 6]
+
+    def test_save(self):
+        self.create_data()
+        user = ShardedUser.at(4).getone()
+        user.name = 'jack'
+        assert user.save() == 1
+        assert ShardedUser.findone(name='jack').id == 4
+        assert user.destroy() == 1
+        assert ShardedUser.count() == 5
+
+    def test_bounds(self):
+        sharding = Sharding(shards, key='name', bounds=('m', ))
+        assert sharding.locate('jack') is shards[0]
+        assert sharding.locate('tom') is shards[1]
+        assert Sharding(shards).locate('tom') is Sharding(shards).locate('tom')
+
+
+class Event(Model):
+    table_name = 't_event'
+    created = Field()
+    name = Field()
+    partitioning = HashPartitioning('name', 2)
+
+
+class MonthlyEvent(Model):
+    table_name = 't_event'
+    created = Field()
+    name = Field()
+    partitioning = MonthPartitioning(
+        'created', date(2026, 8, 1), end=date(2026, 11, 1))
+
+
+event_tables = ['t_event_0', 't_event_1', 't_event_202608',
+                't_event_202609', 't_event_202610', 't_event_202611']
+
+
+class TestPartitioning:
+
+    def setUp(self):
+        for table in event_tables:
+            database.execute('create table %s(id integer primary key, '
+                             'created date, name varchar(33))' % table)
+
+    def tearDown(self):
+        for table in event_tables:
+            database.execute('drop table %s' % table)
+
+    def eq(self, sql, string):
+        return sql.literal == string.replace('?', database.dbapi.placeholder)
+
+    def create_data(self, model):
+        model.insert_many([
+            dict(id=i, created=date(2026, 8 + i % 3, i), name='name%d' % i)
+            for i in range(1, 7)])
+
+    def test_insert(self):
+        self.create_data(Event)
+        assert database.execute('select id from t_event_0').fetchall() == \
+            [(1, ), (2, ), (3, )]
+        assert self.eq(Event.insert(id=7, name='name7').sql,
+                       'insert into t_event_1 (id, name) values (?, ?)')
+        try:
+            Event.create(id=8)
+        except PartitionKeyNotFound:
+            pass
+        else:
+            raise Exception
+
+    def test_prune(self):
+        query = Event.where(name='name2').select(Event.id)
+        assert self.eq(query.sql, 'select t_event.id from t_event_0 as '
+                       't_event where t_event.name = ?')
+        query = MonthlyEvent.where(
+            MonthlyEvent.created.between(date(2026, 9, 1), date(2026, 10, 9)),
+            MonthlyEvent.id > 1).select(MonthlyEvent.id)
+        assert self.eq(query.sql, (
+            'select t_event.id from (select * from t_event_202609 as t_event '
+            'where t_event.created between ? and ? union all select * from '
+            't_event_202610 as t_event where t_event.created between ? and ?)'
+            ' as t_event where t_event.created between ? and ? and '
+            't_event.id > ?'))
+        query = MonthlyEvent.where(
+            MonthlyEvent.created < date(2026, 8, 31)).delete()
+        assert self.eq(query.sqls[0], 'delete from t_event_202608 as '
+                       't_event where t_event.created < ?')
+        assert len(query.sqls) == 1
+
+    def test_select(self):
+        self.create_data(MonthlyEvent)
+        query = MonthlyEvent.where(
+            MonthlyEvent.created >= date(2026, 9, 1),
+            MonthlyEvent.created <= date(2026, 10, 31)).orderby(
+                MonthlyEvent.id).select(MonthlyEvent.id)
+        assert query.execute().tuples() == ((1, ), (2, ), (4, ), (5, ))
+        assert MonthlyEvent.where(
+            MonthlyEvent.created._in(date(2026, 8, 3), date(2026, 8, 6))
+        ).count() == 2
+
+    def test_months(self):
+        self.create_data(MonthlyEvent)
+        MonthlyEvent.create(id=7, created=date(2026, 11, 5), name='name7')
+        assert MonthlyEvent.count() == 7
+        assert MonthlyEvent.where(
+            MonthlyEvent.created >= date(2026, 11, 1)).count() == 1
+        # past the last month
+        try:
+            MonthlyEvent.create(id=8, created=date(2026, 12, 5))
+        except PartitionNotFound:
+            pass
+        else:
+            raise Exception
+        assert MonthlyEvent.where(created=date(2026, 12, 5)).count() == 0
+        assert MonthlyEvent.where(
+            MonthlyEvent.created > date(2026, 12, 1)).count() == 0
+
+    def test_write(self):
+        self.create_data(Event)
+        assert Event.count() == 6
+        event = Event.at(2).getone()
+        event.created = date(2026, 1, 1)
+        assert event.save() == 1
+        event.name = 'name3'  # found by its key in db, same partition
+        assert event.save() == 1
+        event.name = 'name2'
+        assert event.save() == 1
+        assert Event.where(Event.created < date(2026, 2, 1)).select(
+            Event.id).execute().tuples() == ((2, ), )
+        assert Event.where(Event.id > 3).update(name='x').execute() == 3
+        assert Event.where(Event.id > 3).delete().execute() == 3
+        assert Event.count() == 3
+
+
 class TestModel(Test):
 
     def test_insert(self):
@@ -349,6 +1201,27 @@ class TestModel(Test):
         user = User.getone()
         assert user.name == 'jack' and user.email == 'jack@gmail.com'
 
+    def test_insert_many(self):
+        rows = [dict(name='name%d' % i, email='email%d' % i)
+                for i in range(1, 11)]
+        assert User.insert_many(rows, batch_size=4) == list(range(1, 11))
+        assert User.count() == 10
+        assert User.at(7).getone().email == 'email7'
+
+        # batches split by max params and by columns
+        max_params = database.dbapi.max_params
+        database.dbapi.max_params = 5
+        try:
+            ids = User.insert_many([
+                User(name='a', email='a'), User(name='b', email='b'),
+                User(name='c', email='c'), User(name='d'),
+                dict(id=20, name='e'), dict(id=21, name='f')])
+        finally:
+            database.dbapi.max_params = max_params
+        assert ids == [11, 12, 13, 14, 20, 21]
+        assert User.count() == 16
+        assert User.at(21).getone().name == 'f'
+
     def test_update(self):
         user = User.create(name='jack', email='jack@gmail.com')
         assert user.id == 1
@@ -365,15 +1238,68 @@ class TestModel(Test):
     def test_inst_in_model(self):
         user = User.create(name='jack', email='jack@gmail.com')
 
-        # inst with `_in_db=True` won't call db to run a query
-        database.conn.close()  # close conn to test if any sql was executed
-        database.conn = None
-        assert user in User
-        assert database.conn is None
+        executed = []
+        execute_cursor = database.dbapi.execute_cursor
+        database.dbapi.execute_cursor = lambda cursor, args: \
+            executed.append(args) or execute_cursor(cursor, args)
+        try:
+            # inst with `_in_db=True` won't call db to run a query
+            assert user in User
+            assert not executed
 
-        # inst without `_in_db=True` call a query
-        assert User(name='amy') not in User
-        assert database.conn is not None
+            # inst without `_in_db=True` call a query
+            assert User(name='amy') not in User
+            assert executed
+        finally:
+            del database.dbapi.execute_cursor
+
+    def test_reconnect_on_disconnect(self):
+        User.create(name='jack', email='jack@gmail.com')
+        dbapi = database.dbapi
+        execute_cursor = dbapi.execute_cursor
+        errors = []
+
+        def execute_broken(cursor, args):
+            if errors:
+                raise errors.pop()
+            return execute_cursor(cursor, args)
+
+        dbapi.execute_cursor = execute_broken
+        dbapi.is_disconnect = lambda exc: True
+        try:
+            # reads are retried on a new connection
+            errors.append(dbapi.module.OperationalError('gone away'))
+            conn = database.get_conn()
+            assert User.getone().name == 'jack'
+            assert database.conn is not conn
+            # writes are not
+            errors.append(dbapi.module.OperationalError('gone away'))
+            try:
+                User.create(name='amy', email='amy@gmail.com')
+            except dbapi.module.OperationalError:
+                pass
+            else:
+                raise Exception
+            # nor reads in a transaction, which fails till its end
+            try:
+                with database.transaction():
+                    User.create(name='before')
+                    errors.append(dbapi.module.OperationalError('gone away'))
+                    try:
+                        User.getone()
+                    except dbapi.module.OperationalError:
+                        pass
+                    else:
+                        raise Exception
+                    User.create(name='after')
+            except TransactionAborted:
+                pass
+            else:
+                raise Exception
+            assert not database.in_transaction()
+        finally:
+            del dbapi.execute_cursor, dbapi.is_disconnect
+        assert User.count() == 1
 
     def test_select(self):
         User.create(name='jack', email='jack@gmail.com')
@@ -575,7 +1501,7 @@ class TestModel(Test):
         user.email = 'hack@gmail.com'
         assert user.save() == 1  # update
         assert User.getone().email == 'hack@gmail.com'
-        # test inst._cache
+        # test tracking of changed fields
         assert user.save() == 0  # nothing change
 
         user = User(name='jack', email='jack@g.cn')
@@ -587,6 +1513,26 @@ class TestModel(Test):
         else:
             raise Exception
 
+    def test_inst_save_changed(self):
+        assert User.create(name='jack', email='jack@gmail.com')
+        user = User.getone()
+        assert not user._dirty
+        user.name = 'tom'
+        user['email'] = 'tom@gmail.com'
+        assert user._dirty == set(['name', 'email'])
+        assert user.save() == 1
+        assert not user._dirty
+        assert User.getone().name == 'tom'
+        # only changed fields are updated
+        user = User.select(User.id, User.name).execute().one()
+        user.email = 'amy@gmail.com'
+        assert user.save() == 1
+        assert User.getone().name == 'tom'
+        assert User.getone().email == 'amy@gmail.com'
+        # values needn't be hashable
+        user.name = ['amy']
+        assert user._dirty == set(['name'])
+
     def test_inst_desctroy(self):
         user = User(name='jack', email='jack@gmail.com')
         assert user.save() == 1  # insert
@@ -596,6 +1542,59 @@ class TestModel(Test):
         user = User(name='a', email='b')
         assert user.destroy() is None
 
+    def test_execute_async(self):
+        try:
+            import asyncio
+        except ImportError:  # py2
+            return
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            queries = [User.insert(name='name%d' % i) for i in range(1, 21)]
+            ids = loop.run_until_complete(asyncio.gather(
+                *[query.execute_async() for query in queries]))
+            assert sorted(ids) == list(range(1, 21))
+            update = User.at(1).update(name='jack')
+            assert loop.run_until_complete(update.execute_async()) == 1
+            query = User.at(1).select()
+            result = loop.run_until_complete(query.execute_async())
+            assert result.one().name == 'jack'
+            # connections of workers go back to the pool
+            assert len(database.pool.idle) >= database.pool.count - 1
+
+            rows = User.orderby(User.id).select().aiterator(size=3)
+            names = []
+            while True:
+                try:
+                    user = loop.run_until_complete(rows.__anext__())
+                except StopAsyncIteration:
+                    break
+                names.append(user.name)
+            assert len(names) == 20 and names[0] == 'jack'
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_gather(self):
+        self.create_data(4, table=1)
+        results = database.gather(
+            User.where(User.id > 2).select(User.id),
+            User.at(1).update(name='jack'),
+            lambda: User.count(),
+            lambda: User.findone(name='name2'))
+        assert results[0].tuples() == ((3, ), (4, ))
+        assert results[1] == 1
+        assert results[2] == 4
+        assert results[3].id == 2
+        assert len(database.pool.idle) >= database.pool.count - 1
+
+        try:
+            database.gather(User.select(), lambda: User.findone(nonexist=1))
+        except KeyError:
+            pass
+        else:
+            raise Exception
+
     def test_subquery(self):
         self.create_data(10)
 
@@ -679,6 +1678,38 @@ class TestSelectResult(Test):
         users = result.all()
         assert [user.id for user in users] == [1, 2, 3]
 
+    def test_iterator(self):
+        self.create_data(10, table=1)
+        query = User.orderby(User.id).select()
+        ids = []
+        for user in query.iterator(size=3):
+            assert user._in_db
+            ids.append(user.id)
+            assert User.at(user.id).getone().name == user.name
+        assert ids == list(range(1, 11))
+
+        # connection of the stream goes back to the pool
+        idle = len(database.pool.idle)
+        for user in query.iterator(size=3):
+            break
+        assert len(database.pool.idle) == idle
+
+    def test_hydrate_plan(self):
+        self.create_data(2)
+        query = (User & Post).orderby(User.id).select(
+            Post.name, User.name.alias('username'), User.id, Post.post_id)
+        result = query.execute()
+        assert len(result.plans) == 2
+        for user, post in result.all():
+            assert user._in_db and post._in_db
+            assert dict(user) == {'id': user.id}
+            assert user.username == 'name%d' % user.id
+            assert dict(post) == {'name': post.name, 'post_id': post.post_id}
+
+        query = User.select(User.name)
+        user = query.execute().one()
+        assert dict(user) == {'name': 'name1'}
+
     def test_tuples(self):
         assert User.create(name='jack', email='jack@gmail.com')
         assert User.create(name='amy', email='amy@gmail.com')
@@ -687,6 +1718,73 @@ class TestSelectResult(Test):
         result = query.execute()
         assert result.tuples() == ((1,), (2,), (3,))
 
+    def test_row_modes(self):
+        self.create_data(2)
+        query = User.orderby(User.id).select(
+            User.id, User.name.alias('username'))
+        result = query.execute()
+        assert result.dicts() == (
+            {'id': 1, 'username': 'name1'}, {'id': 2, 'username': 'name2'})
+        rows = result.namedtuples()
+        assert rows[0].id == 1 and rows[1].username == 'name2'
+        assert rows[0] == (1, 'name1')
+        records = result.records()
+        assert records[1].id == 2 and records[1].username == 'name2'
+        assert not hasattr(records[0], '__dict__')
+        try:
+            records[0].id = 3
+        except AttributeError:
+            pass
+        else:
+            raise Exception
+        assert type(records[0]) is type(query.execute().records()[0])
+        assert result.scalars() == (1, 2)
+        # multiple models
+        query = (User & Post).orderby(User.id).select(User.name, Post.name)
+        assert query.execute().dicts()[0] == ({'name': 'name1'},
+                                              {'name': 'name2'})
+        assert [user for user, post in
+                query.iterator(mode='namedtuples')][1].name == 'name2'
+        assert list(User.select(User.id).iterator(mode='scalars')) == [1, 2]
+
+    def test_columns(self):
+        self.create_data(3, table=1)
+        User.at(3).update(email=None).execute()
+        query = User.orderby(User.id).select(User.id, User.name, User.email)
+        columns = query.execute().columns()
+        assert columns['id'] == array(columns['id'].typecode, [1, 2, 3])
+        assert columns['name'] == ['name1', 'name2', 'name3']
+        assert columns['email'] == ['email1', 'email2', None]
+        columns = User.select(fn.count(User.id), fn.max(User.id).alias('m'))\
+            .execute().columns()
+        assert list(columns['count(t_user.id)']) == list(columns['m']) == [3]
+        # filled chunk by chunk while fetching
+        query = User.orderby(User.id).select(User.id, User.email)
+        columns = query.columns(size=2)
+        assert list(columns['id']) == [1, 2, 3]
+        assert isinstance(columns['id'], array)
+        assert columns['email'] == ['email1', 'email2', None]
+        # falls back to list
+        columns = Columns(['a', 'b'])
+        columns.extend([(1, 1.5), (2, 2)])
+        assert isinstance(columns.buffers[0], array)
+        columns.extend([(None, 'x')])
+        assert columns.todict() == {'a': [1, 2, None], 'b': [1.5, 2.0, 'x']}
+        # names of multiple models
+        query = (User & Post).select(User.id, Post.post_id)
+        assert set(query.execute().columns()) == set(['t_user.id',
+                                                      't_post.post_id'])
+        assert User.where(User.id > 3).select().columns()['id'] == []
+
+        try:
+            import numpy
+        except ImportError:
+            return
+        columns = User.select(User.id).columns(numpy=True)
+        assert columns['id'].sum() == 6
+        rows = User.orderby(User.id).select(User.id, User.name).execute()
+        assert list(rows.ndarray()['name']) == ['name1', 'name2', 'name3']
+
     def test_selected_inst_in_db(self):
         self.create_data(4, table=1)
         query = User.select()
@@ -708,6 +1806,44 @@ class TestSelectResult(Test):
         users = result.all()
         assert [user.name for user in users] == ['jack', 'amy', 'tom']
 
+    def test_nested_transaction(self):
+        counts = []
+        with database.transaction():
+            User.create(name='jack')
+            # not committed yet, other connections don't see it
+            thread = threading.Thread(
+                target=lambda: counts.append(User.count()))
+            thread.start()
+            thread.join()
+            try:
+                with database.transaction():
+                    User.create(name='tom')
+                    raise ValueError
+            except ValueError:
+                pass
+            with database.transaction():
+                User.create(name='amy')
+        assert counts == [0]
+        assert [user.name for user in User.getall()] == ['jack', 'amy']
+
+        try:
+            with database.transaction():
+                User.create(name='bob')
+                raise ValueError
+        except ValueError:
+            pass
+        assert User.count() == 2
+
+        @database.transaction()
+        def create(names):
+            for name in names:
+                User.create(name=name)
+            return len(names)
+
+        assert create(['a', 'b']) == 2
+        assert User.count() == 4
+        assert not database.in_transaction()
+
     def test_a_lot_of_insert_in_transaction(self):
         database.set_autocommit(False)
         with database.transaction():
@@ -794,6 +1930,68 @@ class TestOperators_:
         assert eq(sql('').op('~')(User.id), ' ~ t_user.id', tuple())
 
 
+class TestSQL_:
+
+    def normalize(self, literal):
+        sq = sql(literal)
+        sq.normalize()
+        return sq.literal
+
+    def test_normalize(self):
+        assert self.normalize(' a  b\n c ') == 'a b c'
+        assert self.normalize('((a))') == '(a)'
+        assert self.normalize('(((a)) and ((b)))') == '((a) and (b))'
+        assert self.normalize('x in ((select 1))') == 'x in (select 1)'
+        assert self.normalize('(a) or (b)') == '(a) or (b)'
+        assert self.normalize('count((a))') == 'count(a)'
+
+    def test_normalize_unbalanced(self):
+        try:
+            self.normalize('(a and (b)')
+        except SQLSyntaxError:
+            pass
+        else:
+            raise Exception
+
+
+class TestCompiler_:
+
+    def test_cache(self):
+        compiler.cache.clear()
+        query1 = User.where(User.id._in(1, 2), name='jack').select()
+        assert len(compiler.cache) == 1
+        query2 = User.where(User.id._in(3, 4), name='amy').select()
+        assert len(compiler.cache) == 1
+        assert query1.sql.literal == query2.sql.literal
+        assert query2.sql.params == (3, 4, 'amy')
+        # different shape
+        query3 = User.where(User.id._in(3, 4, 5), name='amy').select()
+        assert len(compiler.cache) == 2
+        assert query3.sql.params == (3, 4, 5, 'amy')
+
+    def test_cache_same_sql(self):
+        subquery = Post.where(Post.name == 'a').select(Post.user_id)
+        builders = [
+            User.where((User.id > 1) & (
+                (User.name == 'jack') | (User.email.like('%a')))),
+            User.where(User.id._in(subquery)).orderby(User.id, desc=True),
+            User.where(sql('t_user.id > 1')).groupby(User.name).having(
+                fn.count(User.id) > 1).limit(2, offset=1),
+            User & Post,
+        ]
+        cache_size = compiler.cache_size
+        compiler.cache_size = 0
+        try:
+            sqls = [builder.select().sql for builder in builders]
+        finally:
+            compiler.cache_size = cache_size
+        for sq, builder in zip(sqls, builders):
+            for i in range(2):  # compile, then hit cache
+                query = builder.select()
+                assert query.sql.literal == sq.literal
+                assert query.sql.params == sq.params
+
+
 class TestCommonFunctions(Test):
 
     def test_count(self):